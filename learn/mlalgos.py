@@ -62,6 +62,14 @@ def get_estimator(algoname, seed=0):
     print("Unrecognized algorithm name")
     return
 
+def prepare_features(algoname, features):
+    ''' Returns features in a form that the algoname estimator can fit.
+    Most estimators take scipy.sparse matrices (from mldata.load_sparse) as
+    they are; GaussianNB only takes dense arrays, so those get densified.'''
+    if(algoname == 'nb' and hasattr(features, 'toarray')):
+        return features.toarray()
+    return features
+
 # This function will be used to learn using an arbitrary algorithm
 def learn(algoname, trainx, trainy, seed):
     '''
@@ -16,47 +16,541 @@
 # scikit learn will provide most of the baseline funtionality
 import numpy as np
 import numpy.lib.recfunctions as rfunc
+from numpy.lib._iotools import easy_dtype
+import scipy.sparse as sp
+from array import array
+import json
+import os
 import random
 import sys
+import weakref
+import zlib
+try:
+    import zstandard # optional; only needed to save .zst databases
+except ImportError:
+    zstandard = None
 
 # TODO: make it easy to import and export data
 # check out numpy.recarray.tofile and .fromfile
 
-def load_data(csv):
+LOAD_CHUNK_LINES = 1 << 16 # lines parsed at a time by parse_csv
+COUNT_BLOCKSIZE = 1 << 24 # bytes read at a time when counting lines
+SAVE_CHUNK_ROWS = 1 << 14 # rows formatted and written at a time by save_data
+INT64_LIMITS = np.iinfo(np.int64) # numpy.fromstring clamps to these
+
+# Feature matrices that feature_matrix had to copy, by id of the structured
+# array: (weak reference to the array, feature names, matrix)
+FEATURE_CACHE = {}
+
+def load_data(csv, cache=True):
     ''' Import a csv file. Returns a structured array of the following format:
     [[name, feature0, ..., featuren, label], [name, ..., label], ...] 
     Note: "--" will be treated as a comment delimiter. I do not expect to use
-    comments, but numpy.genfromtxt needs something.'''
+    comments, but numpy.genfromtxt needs something.
+    The file is parsed with parse_csv. Files it can not parse (e.g. with
+    missing or non-integer values) are handed to numpy.genfromtxt instead,
+    which is much slower.
+    If cache, the parsed array is saved next to the csv as a .npy sidecar
+    (see sidecar_path), and this and later loads of the unchanged csv
+    memory-map the sidecar instead of parsing. Processes loading the same
+    database then share its pages. The map is copy-on-write, so the array
+    can be changed in place like a parsed one; changes are never written
+    back. The sidecar is skipped silently if it can not be written.'''
+
+    sidecar = None
+    if(cache):
+        sidecar = sidecar_path(csv)
+    if(sidecar is not None and os.path.exists(sidecar)):
+        data = load_sidecar(sidecar)
+        if(data is not None):
+            return data
+        # a broken sidecar; parse the csv and replace it
+
+    data = parse_data(csv)
+    if(sidecar is not None and save_sidecar(data, sidecar)):
+        # The same kind of array as from later loads
+        mapped = load_sidecar(sidecar)
+        if(mapped is not None):
+            return mapped
+    return data
 
+def load_sidecar(sidecar):
+    ''' Memory-maps a sidecar copy-on-write, or returns None if it can not
+    be read. '''
+    try:
+        return np.load(sidecar, mmap_mode='c')
+    except (IOError, ValueError):
+        return None
+
+def parse_data(csv):
+    ''' Parses an open csv file, header line and all, into the structured
+    array described in load_data. '''
     dformat = extract_headers(csv)
 
+    # Remember where the data starts, in case parse_csv gives up
+    try:
+        start = csv.tell()
+    except (IOError, AttributeError):
+        start = None
+
+    data = parse_csv(csv, dformat)
+    if(data is not None):
+        return data
+    if(start is None):
+        raise ValueError('Could not parse {}, and it can not be reread'\
+            .format(getattr(csv, 'name', csv)))
+    csv.seek(start)
+
     # Load file data as a matrix
     data = np.genfromtxt(csv, delimiter=", ", dtype=dformat, skip_header=0, \
            comments='--')
 
     return data
 
-def save_data(data, outfile):
+def sidecar_path(csv):
+    ''' Returns the name of the .npy sidecar of an open csv file, which
+    sits next to it and is keyed on its size and modification time, e.g.
+    db.csv.1234.1396000000000000.npy. Returns None if csv is not a regular
+    file (e.g. stdin). '''
+    path = getattr(csv, 'name', None)
+    if(not isinstance(path, basestring)):
+        return None
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    if(not os.path.isfile(path)):
+        return None
+    return '{}.{}.{}.npy'.format(os.path.abspath(path), st.st_size, \
+        int(st.st_mtime * 1000000))
+
+def save_sidecar(data, sidecar):
+    ''' Writes data to sidecar atomically (concurrent loads see either no
+    sidecar or a whole one), and removes the sidecars of older versions of
+    the same csv. Gives up silently if the directory is not writable.
+    Returns whether the sidecar was written. '''
+    if(data.ndim == 0 or data.size == 0):
+        # Empty arrays can not be memory-mapped, and the 0-d array genfromtxt
+        # makes of a single line is left as it is
+        return False
+    tmp = '{}.{}.tmp'.format(sidecar, os.getpid())
+    try:
+        with open(tmp, 'wb') as out:
+            np.save(out, data)
+        os.rename(tmp, sidecar)
+    except (IOError, OSError):
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        return False
+
+    # Other sidecars of the same csv: <csv name>.<size>.<mtime>.npy
+    dirname, base = os.path.split(sidecar.rsplit('.', 3)[0])
+    for fname in os.listdir(dirname):
+        parts = fname[len(base):].split('.')
+        if(fname.startswith(base) and len(parts) == 4 and parts[0] == '' \
+                and parts[1].isdigit() and parts[2].isdigit() \
+                and parts[3] == 'npy'):
+            old = os.path.join(dirname, fname)
+            if(old != sidecar):
+                try:
+                    os.remove(old)
+                except OSError:
+                    pass
+    return True
+
+def count_lines(openfile):
+    ''' Counts the lines left in a seekable open file, and goes back to
+    where it was. Returns None if the file is not seekable. '''
+    try:
+        start = openfile.tell()
+        lines = 1 # the last line may not end with a newline
+        block = openfile.read(COUNT_BLOCKSIZE)
+        while(block):
+            lines += block.count('\n')
+            block = openfile.read(COUNT_BLOCKSIZE)
+        openfile.seek(start)
+    except (IOError, AttributeError):
+        return None
+    return lines
+
+def split_name(line, namecol):
+    ''' Splits a csv line into its Name field (column namecol) and the
+    line without it, e.g. ("a.exe", "1, 5, 2") for ("1, a.exe, 5, 2", 1).
+    Returns None if the line has too few fields. '''
+    # Start and end of the name field
+    begin = 0
+    for _ in range(namecol):
+        begin = line.find(', ', begin)
+        if(begin < 0):
+            return None
+        begin += 2
+    end = line.find(', ', begin)
+    if(end < 0):
+        return (line[begin:], line[:max(begin - 2, 0)])
+    if(begin == 0):
+        return (line[:end], line[end + 2:])
+    return (line[begin:end], line[:begin - 2] + line[end:])
+
+def csv_chunks(csv, dformat):
+    ''' Generates the rest of an open csv file (after the header line) as
+    (names, ints) chunks of up to LOAD_CHUNK_LINES lines: the Name field of
+    every line, and a (lines, fields) int64 array of all of the other fields,
+    in the order of dformat (as returned by parse_dtype). All of the integers
+    of a chunk are parsed in one call to numpy.fromstring, after every line
+    is checked for the right number of fields, so that a line with too many
+    and one with too few can not make up for each other.
+    Raises ValueError on a line that does not fit dformat, or a chunk with
+    an empty (missing) field or an integer fromstring may have clamped to
+    the int64 range, so that the caller can leave those to genfromtxt. '''
+    names = list(dformat.names)
+    namecol = names.index('Name')
+    nints = len(names) - 1
+
+    while(True):
+        lines = []
+        recnames = []
+        for line in csv:
+            if('--' in line): # genfromtxt's comments
+                line = line[:line.index('--')]
+            line = line.strip()
+            if(not line):
+                continue
+            parts = split_name(line, namecol)
+            if(parts is None or parts[1].count(',') != max(nints - 1, 0)):
+                raise ValueError('Wrong number of fields: {}'.format(line))
+            recnames.append(parts[0])
+            lines.append(parts[1])
+            if(len(lines) >= LOAD_CHUNK_LINES):
+                break
+        if(not lines):
+            return
+
+        # Every integer in the chunk, row by row
+        text = ', '.join(lines)
+        if(nints and empty_field(text)):
+            raise ValueError('Missing values in lines {}'.format(lines[0]))
+        ints = np.fromstring(text, dtype=np.int64, sep=',')
+        if(ints.size != len(lines) * nints):
+            raise ValueError('Not all integers in lines {}'.format(lines[0]))
+        if(ints.size and (ints.max() == INT64_LIMITS.max or \
+                ints.min() == INT64_LIMITS.min)):
+            raise ValueError('Integer out of range in lines {}'.format( \
+                lines[0]))
+        yield (recnames, ints.reshape(len(lines), nints))
+
+def empty_field(text):
+    ''' Whether some field of the comma separated text is empty (or only
+    whitespace), which numpy.fromstring would read as 0. Dropping the
+    whitespace first leaves one substring search, much faster than a regular
+    expression on wide databases. '''
+    text = text.translate(None, ' \t\r\n\v\f')
+    return ',,' in text or text.startswith(',') or text.endswith(',')
+
+def parse_dtype(dformat):
+    ''' The dtype numpy.genfromtxt would make of dformat. genfromtxt drops
+    characters like = and > from the field names, so the arrays built here
+    do the same to match. '''
+    return easy_dtype(dformat, defaultfmt='f%i')
+
+def parse_csv(csv, dformat):
+    ''' Parses the rest of an open csv file (after the header line) into a
+    structured array of dtype dformat, from extract_headers: 64-bit integers
+    and the Name string.
+    The csv_chunks are copied into columns of an array that is allocated up
+    front (when the file can be seeked to count its lines). Returns None,
+    having read some of the file, if a line does not fit dformat. '''
+    dformat = parse_dtype(dformat)
+    intnames = [name for name in dformat.names if name != 'Name']
+
+    # Preallocate if the size of the file can be known, otherwise gather
+    # the chunks and join them at the end
+    nlines = count_lines(csv)
+    if(nlines is not None):
+        data = np.zeros(nlines, dtype=dformat)
+    chunks = []
+    filled = 0
+
+    try:
+        for recnames, ints in csv_chunks(csv, dformat):
+            if(nlines is not None):
+                chunk = data[filled:filled + len(recnames)]
+            else:
+                chunk = np.zeros(len(recnames), dtype=dformat)
+                chunks.append(chunk)
+            chunk['Name'] = recnames
+            for col, name in enumerate(intnames):
+                chunk[name] = ints[:, col]
+            filled += len(recnames)
+    except ValueError:
+        return None
+
+    if(nlines is None):
+        if(not chunks):
+            return np.zeros(0, dtype=dformat)
+        return np.concatenate(chunks)
+    return data[:filled]
+
+def load_sparse(dbfile):
+    ''' Import a sparse database written by scan/imports.py --format
+    svmlight or npz. dbfile can be a file name or an open file (npz files are
+    reopened by name, since they are binary).
+    Returns (features, labels, recordfilenames, featurenames) like
+    data_components, except that features is a scipy.sparse csr_matrix.'''
+
+    fname = getattr(dbfile, 'name', dbfile)
+    if(fname.endswith('.npz')):
+        npz = np.load(fname)
+        features = sp.csr_matrix((npz['data'], npz['indices'], \
+            npz['indptr']), shape=tuple(npz['shape']))
+        return (features, npz['labels'], npz['names'], \
+            tuple(npz['featnames']))
+
+    if(not hasattr(dbfile, 'readline')):
+        dbfile = open(dbfile, 'r')
+
+    # The header comment names the features: "# isMalware, Name, ..."
+    featnames = ()
+    data = array('l')
+    indices = array('l')
+    indptr = array('l', [0])
+    labels = array('l')
+    names = []
+    for line in dbfile:
+        line = line.strip()
+        if(line.startswith('#')):
+            nmes = line[1:].replace(' ', '').split(',')
+            featnames = tuple(nmes[2:])
+            continue
+        if(not line):
+            continue
+
+        # "label i:v i:v ... # name"
+        record, _, name = line.partition('#')
+        fields = record.split()
+        labels.append(int(fields[0]))
+        for field in fields[1:]:
+            i, v = field.split(':')
+            indices.append(int(i))
+            data.append(int(v))
+        indptr.append(len(indices))
+        names.append(name.strip())
+
+    ncols = len(featnames)
+    if(indices):
+        ncols = max(ncols, max(indices) + 1)
+    features = sp.csr_matrix((np.array(data, dtype=np.int64), \
+        np.array(indices, dtype=np.int32), np.array(indptr, dtype=np.int64)), \
+        shape=(len(labels), ncols))
+    return (features, np.array(labels, dtype=np.int64), \
+        np.array(names, dtype='a255'), featnames)
+
+MEMMAP_META = 'meta.json' # column names, types, rows and source of a MemmapData
+MEMMAP_CHUNK_ROWS = 1 << 16 # rows materialized at a time when iterating
+
+def memmap_data(csv, dirname):
+    ''' Returns a MemmapData of the open csv file, stored in dirname. The
+    column files are (re)built from the csv first if they are missing, or if
+    the csv changed since they were built. '''
+    st = os.stat(csv.name)
+    source = [os.path.abspath(csv.name), st.st_size, st.st_mtime]
+    try:
+        with open(os.path.join(dirname, MEMMAP_META)) as metafile:
+            if(json.load(metafile)['source'] == source):
+                return MemmapData(dirname)
+    except (IOError, ValueError, KeyError):
+        pass
+    build_memmap(csv, dirname, source)
+    return MemmapData(dirname)
+
+def build_memmap(csv, dirname, source=None):
+    ''' Converts an open csv file into one .npy column file per field in
+    dirname, a chunk at a time, so the database never has to fit in memory.
+    The metadata is written last, so a MemmapData only ever sees complete
+    columns. source is recorded in it to tell when the csv changes. '''
+    if(not os.path.isdir(dirname)):
+        os.makedirs(dirname)
+    dformat = parse_dtype(extract_headers(csv))
+    names = list(dformat.names)
+    intnames = [name for name in names if name != 'Name']
+    nlines = count_lines(csv)
+    if(nlines is None):
+        raise ValueError('{} can not be seeked'.format(csv))
+
+    # Allocate for every line, and record how many rows there really were
+    columns = {}
+    for col, name in enumerate(names):
+        columns[name] = np.lib.format.open_memmap(os.path.join(dirname, \
+            'col{}.npy'.format(col)), mode='w+', dtype=dformat[name], \
+            shape=(nlines,))
+    filled = 0
+    for recnames, ints in csv_chunks(csv, dformat):
+        rows = slice(filled, filled + len(recnames))
+        columns['Name'][rows] = recnames
+        for col, name in enumerate(intnames):
+            columns[name][rows] = ints[:, col]
+        filled += len(recnames)
+    for column in columns.values():
+        column.flush()
+    del columns
+
+    meta = {'names': names, 'formats': [dformat[name].str for name in names], \
+        'rows': filled, 'source': source}
+    tmp = os.path.join(dirname, MEMMAP_META + '.tmp')
+    with open(tmp, 'w') as metafile:
+        json.dump(meta, metafile)
+    os.rename(tmp, os.path.join(dirname, MEMMAP_META))
+
+class MemmapData(object):
+    ''' A database too large for memory, kept as one memory-mapped .npy
+    file per column (see build_memmap). It stands in for the structured
+    array from load_data:
+    data['field'] is that column (a read-only memmap),
+    data[['field', ...]] is a MemmapData of only those fields, so that
+        rm_feat_name and only_features work on it as they are,
+    data[rows] (an index, slice, mask or list of indices) reads just those
+        rows into an ordinary structured array,
+    data_components(data) gives a MemmapFeatures instead of a 2d array.
+    Nothing is read from disk until it is indexed. '''
+
+    def __init__(self, dirname, names=None):
+        with open(os.path.join(dirname, MEMMAP_META)) as metafile:
+            meta = json.load(metafile)
+        self.dirname = dirname
+        self.rows = meta['rows']
+        self.files = dict((str(name), 'col{}.npy'.format(col)) \
+            for col, name in enumerate(meta['names']))
+        formats = dict(zip(meta['names'], meta['formats']))
+        if(names is None):
+            names = meta['names']
+        names = [str(name) for name in names]
+        self.dtype = np.dtype({'names': names, \
+            'formats': [str(formats[name]) for name in names]})
+        self.shape = (self.rows,)
+
+    def __len__(self):
+        return self.rows
+
+    def column(self, name):
+        ''' The memory-mapped column of field name '''
+        if(name not in self.dtype.names):
+            raise ValueError('no field of name {}'.format(name))
+        return np.load(os.path.join(self.dirname, self.files[name]), \
+            mmap_mode='r')[:self.rows]
+
+    def __getitem__(self, key):
+        if(isinstance(key, basestring)):
+            return self.column(key)
+        if(isinstance(key, list) and key and isinstance(key[0], basestring)):
+            return MemmapData(self.dirname, key)
+
+        # Rows: read only those, one column at a time
+        names = self.dtype.names
+        first = np.asarray(self.column(names[0])[key])
+        out = np.zeros(first.shape, dtype=self.dtype)
+        out[names[0]] = first
+        for name in names[1:]:
+            out[name] = self.column(name)[key]
+        return out
+
+    def __iter__(self):
+        for start in range(0, self.rows, MEMMAP_CHUNK_ROWS):
+            for record in self[start:start + MEMMAP_CHUNK_ROWS]:
+                yield record
+
+    def components(self):
+        ''' data_components for a MemmapData. Only the labels are read
+        into memory. '''
+        featnames = tuple(name for name in self.dtype.names \
+            if name not in ('Name', 'isMalware'))
+        return (MemmapFeatures(self, featnames), \
+            np.array(self.column('isMalware')), self.column('Name'), featnames)
+
+class MemmapFeatures(object):
+    ''' The 2d feature matrix of a MemmapData, for the estimators and the
+    cross validation. features[rows] reads just the given rows (as for a
+    training or test split) into an int64 array. '''
+
+    def __init__(self, data, featnames):
+        self.data = data
+        self.featnames = featnames
+        self.shape = (len(data), len(featnames))
+        self.dtype = np.dtype(np.int64)
+        self.ndim = 2
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, rows):
+        first = np.asarray(self.data.column(self.featnames[0])[rows])
+        out = np.zeros(first.shape + (len(self.featnames),), dtype=np.int64)
+        for col, name in enumerate(self.featnames):
+            out[..., col] = self.data.column(name)[rows]
+        return out
+
+    def __array__(self, dtype=None):
+        ''' Reads the whole matrix, for code that needs a real array. '''
+        return np.asarray(self[:], dtype=dtype)
+
+def save_data(data, outfile, compress=None):
     ''' Takes a record array (like that returned by mldata.load_data) and
-    saves it as a .csv file that could be imported by mldata.load_data. '''
+    saves it as a .csv file that could be imported by mldata.load_data. 
+    If compress is 'gzip' or 'zstd' (which needs the zstandard module), the
+    csv is compressed with it instead, for archiving. load_data and the
+    other loaders can NOT read that back; decompress it first (gunzip,
+    unzstd), which gives the same bytes as an uncompressed save.
+    The records are formatted SAVE_CHUNK_ROWS at a time, a column at a time,
+    and every chunk goes out in one write. '''
+
+    compressor = make_compressor(compress)
+
+    def write(text):
+        if(compressor is not None):
+            text = compressor.compress(text)
+        outfile.write(text)
 
     # Get header names
     hnames = data.dtype.names
 
     # Print header names
-    hline = ', '.join(hnames) + '\n'
-    outfile.write(hline)
+    write(', '.join(hnames) + '\n')
 
-    # For every line in the array...
-    for record in data:
-        # Print that line
-        # (Use list comprehension to get a string version of the record)
-        recline = ', '.join((str(x) for x in record)) + '\n'
-        outfile.write(recline)
+    # Print the records a chunk at a time, as str(x) of every value
+    for start in range(0, len(data), SAVE_CHUNK_ROWS):
+        chunk = data[start:start + SAVE_CHUNK_ROWS]
+        columns = [field_strings(chunk[name]) for name in hnames]
+        write(''.join(', '.join(record) + '\n' for record in zip(*columns)))
 
-    # For clarity
+    if(compressor is not None):
+        outfile.write(compressor.flush())
     return
 
+def field_strings(column):
+    ''' Returns str(x) for every value x of a 1d array, as a list.
+    Integers and strings are first turned into python objects all at once
+    (tolist), which str formats the same way as the numpy scalars, and much
+    faster. Other types are formatted one numpy scalar at a time. '''
+    if(column.dtype.kind == 'S'):
+        return column.tolist()
+    if(column.dtype.kind in 'iu'):
+        return [str(x) for x in column.tolist()]
+    return [str(x) for x in column]
+
+def make_compressor(compress):
+    ''' Returns an object with compress(text) and flush() methods that
+    produces a gzip or zstd stream, or None if compress is None. '''
+    if(compress is None):
+        return None
+    if(compress == 'gzip'):
+        # (wbits 16 + 15 writes a gzip header and trailer)
+        return zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    if(compress == 'zstd'):
+        if(zstandard is None):
+            raise ValueError('zstd compression needs the zstandard module')
+        return zstandard.ZstdCompressor().compressobj()
+    raise ValueError('unknown compression {}'.format(compress))
+
 def train_test_split(seed, labels, numsamples, malprev):
     ''' Returns indices [2 numpy arrays] for training and test data.
     
@@ -192,7 +686,11 @@ def data_components(data):
     features (2d array), labels, record names, and the feature names.
     This is intended to be used after preprocessing as the final step before
     doing the actual learning.
-    Returns (features, labels, recordfilenames, featurenames)'''
+    Returns (features, labels, recordfilenames, featurenames)
+    For a MemmapData, features is a MemmapFeatures.'''
+
+    if(isinstance(data, MemmapData)):
+        return data.components()
     
     # Get filenames
     recnames = data['Name']
@@ -201,13 +699,47 @@ def data_components(data):
     labels = data['isMalware']
 
     # Get features
-    features = rm_feat_name(data, 'Name')
-    features = rm_feat_name(features, 'isMalware')
-    featnames = features.dtype.names
-    simplefeatures = features.view(np.int64).reshape(features.shape + (-1,))
+    featnames = tuple(name for name in data.dtype.names \
+        if name not in ('Name', 'isMalware'))
+    simplefeatures = feature_matrix(data, featnames)
 
     return (simplefeatures, labels, recnames, featnames)
 
+def feature_matrix(data, featnames):
+    ''' Returns the fields featnames of a 1d structured array as a 2d int64
+    array, without building an intermediate structured array.
+    If the fields are consecutive native int64s (as load_data makes them),
+    this is a view of data with the same row stride, and nothing is copied.
+    Otherwise the fields are copied, once, into one contiguous array, which
+    is kept (in FEATURE_CACHE) for as long as data is, so the next call on
+    the same data and fields returns it again. Changing data in place does
+    not update that copy. '''
+    fields = data.dtype.fields
+    int64 = np.dtype(np.int64)
+    offsets = [fields[name][1] for name in featnames]
+    if(featnames and all(fields[name][0] == int64 for name in featnames) \
+            and offsets == [offsets[0] + 8*i for i in range(len(offsets))]):
+        # Step along the rows of the first field, and 8 bytes across them
+        return np.lib.stride_tricks.as_strided(data[featnames[0]], \
+            shape=(len(data), len(featnames)), strides=(data.strides[0], 8))
+
+    key = id(data)
+    cached = FEATURE_CACHE.get(key)
+    if(cached is not None and cached[0]() is data and cached[1] == featnames):
+        return cached[2]
+
+    matrix = np.empty((len(data), len(featnames)), dtype=np.int64)
+    for col, name in enumerate(featnames):
+        matrix[:, col] = data[name]
+
+    # The matrix does not refer to data, so data can still be freed, which
+    # drops the entry
+    def forget(ref):
+        if(FEATURE_CACHE.get(key, (None,))[0] is ref):
+            del FEATURE_CACHE[key]
+    FEATURE_CACHE[key] = (weakref.ref(data, forget), featnames, matrix)
+    return matrix
+
 def rm_feat_num(features, num):
     ''' Return features, with a feature removed based on column (num)ber '''
     names = list(features.dtype.names)
@@ -37,17 +37,26 @@ def sometrials(options):
     ''' Runs a single machine learning trial. '''
     
     # Load the data
-    data = mldata.load_data(options.database)
+    if(options.sparse):
+        # Sparse databases go straight to the components
+        features, labels, _, featnames = mldata.load_sparse(options.database)
+        features = mlalgos.prepare_features(options.algorithm, features)
+    else:
+        if(options.memmap):
+            # Out of core: features are read from the column files as needed
+            data = mldata.memmap_data(options.database, options.memmap)
+        else:
+            data = mldata.load_data(options.database)
 
-    # Preprocess data
-    # TODO: fill in this part
+        # Preprocess data
+        # TODO: fill in this part
 
-    # If specified, output the current database
-    if(options.exportdb != None):
-        mldata.save_data(data, options.exportdb)
+        # If specified, output the current database
+        if(options.exportdb != None):
+            mldata.save_data(data, options.exportdb, options.exportcompress)
 
-    # Extract the basic data from the data
-    features, labels, _, featnames = mldata.data_components(data)
+        # Extract the basic data from the data
+        features, labels, _, featnames = mldata.data_components(data)
 
     # Get the seeds for the splits.
     numsplits = 10 # Make this an option later, if need be.
@@ -132,7 +141,7 @@ def oldtrial(options):
 
     # If specified, output the current database
     if(options.exportdb != None):
-        mldata.save_data(sample, options.exportdb)
+        mldata.save_data(sample, options.exportdb, options.exportcompress)
 
     # Original way to run a trial... probably going to be deleted eventually
     if(options.acc):
@@ -200,6 +209,9 @@ def clargs():
         TEST is the fraction for the test data.')
     parser.add_argument('-e', '--exportdb', type=argparse.FileType('w'), \
         help='file to export post-sampled/preprocessed database to')
+    parser.add_argument('--export-compress', dest='exportcompress', \
+        choices=['gzip', 'zstd'], help='compress the --exportdb file, for \
+        archiving; it has to be decompressed before it can be loaded again')
     parser.add_argument('--acc', default=False, action='store_true', \
         help='Run a simple accuracy trial without CV')
     parser.add_argument('-b', '--beta', default=1.0, type=float, \
@@ -207,6 +219,12 @@ def clargs():
     # The graphfile is taken as a string because that's how the library takes it
     parser.add_argument('-g', '--graphfile', \
         help='if decision trees are used, specifies a file to write a graph to')
+    parser.add_argument('--sparse', default=False, action='store_true', \
+        help='the database is a sparse svmlight or .npz file from \
+        imports.py --format (--exportdb is ignored)')
+    parser.add_argument('--memmap', metavar='DIR', \
+        help='keep the database in memory-mapped column files in DIR \
+        (built from the csv when missing or out of date) rather than in memory')
     args = parser.parse_args()
 
     return args
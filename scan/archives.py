@@ -0,0 +1,122 @@
+""" Reads the members of sample archives into memory for the scanners. """
+###############################################################
+# Name:         archives
+# Description:  The malware feed comes as zip files protected with the
+#               password 'infected'. Instead of extracting them to disk (like
+#               flatten.unzipmalware) and reading them back, pescanner
+#               --archives reads every member of a zip or tar archive
+#               straight into a buffer and scans that. Nothing is written to
+#               disk, and each archive is read once.
+#
+#               Members are named archive!member in the scan output.
+#
+#               Members are not read as they are listed: iter_members hands
+#               out a function that reads one, so that pescanner can read it
+#               under its --timeout and --max-memory budget, and it reads at
+#               most one byte past --max-size whatever the header claims, so
+#               a lying header or a zip bomb can not inflate without limit.
+###############################################################
+
+import zipfile
+import tarfile
+import zlib
+from functools import partial
+
+###############################################################
+# CONSTANTS ####################
+ARCHIVE_PASSWORD = 'infected' # the usual password of malware zips
+MEMBER_SEPARATOR = '!'
+
+# What reading a member can raise. RuntimeError is a wrong zip password,
+# NotImplementedError an unsupported compression or encryption method.
+READ_ERRORS = (zipfile.BadZipfile, RuntimeError, NotImplementedError, \
+    zlib.error, tarfile.TarError, IOError, EOFError)
+
+###############################################################
+# FUNCTIONS ####################
+
+def member_name(archive, member):
+    """The name a member of an archive is reported under"""
+    return '%s%s%s' % (archive, MEMBER_SEPARATOR, member)
+
+def archive_type(pathname):
+    """
+    Returns 'zip' or 'tar' if pathname is an archive, otherwise None.
+    Self-extracting executables are PE files with a zip appended, so files
+    that start with MZ are never treated as archives.
+    """
+    try:
+        with open(pathname, 'rb') as f:
+            if(f.read(2) == 'MZ'):
+                return None
+    except IOError:
+        return None # let the scan report the problem
+    if(zipfile.is_zipfile(pathname)):
+        return 'zip'
+    try:
+        if(tarfile.is_tarfile(pathname)):
+            return 'tar'
+    except (IOError, EOFError):
+        pass
+    return None
+
+def read_limited(open_member, maxsize=None):
+    """Reads a member from the file object open_member() returns, and
+    returns its content, or None if it is over maxsize bytes. At most
+    maxsize + 1 bytes are decompressed."""
+    f = open_member()
+    try:
+        if(maxsize is None):
+            return f.read()
+        data = f.read(maxsize + 1)
+    finally:
+        f.close()
+    if(len(data) > maxsize):
+        return None
+    return data
+
+def iter_zip(pathname, maxsize=None, password=ARCHIVE_PASSWORD):
+    """Generates (member, read, error) for every file in a zip archive"""
+    zf = zipfile.ZipFile(pathname)
+    try:
+        zf.setpassword(password)
+        for info in zf.infolist():
+            if(info.filename.endswith('/')):
+                continue # a directory
+            if(maxsize is not None and info.file_size > maxsize):
+                yield (info.filename, None, 'larger than %d bytes' % maxsize)
+                continue
+            yield (info.filename, partial(read_limited, \
+                partial(zf.open, info), maxsize), None)
+    finally:
+        zf.close()
+
+def iter_tar(pathname, maxsize=None):
+    """Generates (member, read, error) for every file in a tar archive
+    (compressed or not)"""
+    tf = tarfile.open(pathname)
+    try:
+        for info in tf:
+            if(not info.isfile()):
+                continue
+            if(maxsize is not None and info.size > maxsize):
+                yield (info.name, None, 'larger than %d bytes' % maxsize)
+                continue
+            yield (info.name, partial(read_limited, \
+                partial(tf.extractfile, info), maxsize), None)
+    finally:
+        tf.close()
+
+def iter_members(pathname, kind, maxsize=None):
+    """
+    Generates (member, read, error) for every file in the archive pathname
+    of type kind (from archive_type). read() returns the member's content,
+    or None if it turns out to be over maxsize bytes, and can raise any of
+    READ_ERRORS. It must be called before the next member is generated.
+    read is None for members whose header already says they are over
+    maxsize bytes, in which case error says so.
+    Only one member is held in memory at a time.
+    """
+    if(kind == 'zip'):
+        return iter_zip(pathname, maxsize)
+    return iter_tar(pathname, maxsize)
@@ -0,0 +1,141 @@
+from __future__ import print_function
+
+''' Benchmarks for the scanners. '''
+
+###############################################################
+# Name:         bench
+# Description:  entropy: compares pefile's section.get_entropy() with
+#               bytestats.section_entropy on the sections of the given PE
+#               files, and on a random buffer of --size MB.
+#
+#               scan: measures pescanner (and optionally imports.py)
+#               throughput on synthetic corpora from synthpe.py, by default
+#               of 1k, 100k and 1M files. The corpus is written once to
+#               --corpus and reused; each size scans a prefix of it.
+#
+###############################################################
+
+import pefile
+import argparse
+import os
+import time
+import bytestats
+import synthpe
+import pescanner
+import imports
+
+def best_time(func, repeat):
+    ''' Returns the best wall clock time of repeat calls to func. '''
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        func()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def report(label, nbytes, oldtime, newtime):
+    ''' Prints one line comparing the pefile and numpy timings. '''
+    mb = nbytes / float(1 << 20)
+    print('{:40} {:9.2f} MB  pefile {:8.1f} MB/s  numpy {:8.1f} MB/s  {:6.1f}x'\
+        .format(label[-40:], mb, mb / max(oldtime, 1e-9), \
+        mb / max(newtime, 1e-9), oldtime / max(newtime, 1e-9)))
+
+def bench_entropy(args):
+    ''' pefile entropy vs bytestats entropy. '''
+    for fname in args.files:
+        pe = pefile.PE(fname)
+        nbytes = sum(s.SizeOfRawData for s in pe.sections)
+
+        def old():
+            return [s.get_entropy() for s in pe.sections]
+        def new():
+            return [bytestats.section_entropy(pe, s) for s in pe.sections]
+
+        # The two implementations must agree before their speed matters
+        worst = max([abs(a - b) for a, b in zip(old(), new())] + [0.0])
+        if worst > 1e-9:
+            print('[-] {}: entropies differ by {}'.format(fname, worst))
+
+        report(fname, nbytes, best_time(old, args.repeat), \
+            best_time(new, args.repeat))
+
+    if args.size:
+        data = os.urandom(args.size << 20)
+        # entropy_H does not use its section, so call the plain function
+        entropy_H = pefile.SectionStructure.__dict__['entropy_H']
+        report('random buffer', len(data), \
+            best_time(lambda: entropy_H(None, data), args.repeat), \
+            best_time(lambda: bytestats.entropy(data), args.repeat))
+
+def bench_scan(args):
+    ''' pescanner and imports.py throughput on synthetic corpora. '''
+    sizes = sorted(args.sizes)
+    start = time.time()
+    written = synthpe.write_corpus(args.corpus, sizes[-1], args)
+    if written:
+        print('Wrote {} corpus files in {:.1f} s'.format(written, \
+            time.time() - start))
+
+    settings = {'fast': args.fast}
+    for count in sizes:
+        paths = [synthpe.corpus_path(args.corpus, i) for i in range(count)]
+        nbytes = sum(os.path.getsize(path) for path in paths)
+
+        start = time.time()
+        rows = 0
+        jobs = pescanner.scan_jobs(paths, 'clean')
+        for result in pescanner.scan_files(jobs, args.workers, True, settings):
+            if result.row is not None:
+                rows += 1
+        elapsed = max(time.time() - start, 1e-9)
+        print('pescanner  {:8d} files  {:8.1f} files/s  {:7.2f} MB/s  \
+({} rows, {} workers{})'.format(count, count / elapsed, \
+            nbytes / float(1 << 20) / elapsed, rows, args.workers, \
+            ', fast' if args.fast else ''))
+
+        if args.imports:
+            start = time.time()
+            for path in paths:
+                imports.getImps(path)
+            elapsed = max(time.time() - start, 1e-9)
+            print('imports    {:8d} files  {:8.1f} files/s  {:7.2f} MB/s'\
+                .format(count, count / elapsed, \
+                nbytes / float(1 << 20) / elapsed))
+
+def main():
+    ''' The main function.'''
+    parser = argparse.ArgumentParser(description='Scanner benchmarks.')
+    sub = parser.add_subparsers()
+
+    ent = sub.add_parser('entropy', help='pefile vs numpy section entropy')
+    ent.add_argument('files', nargs='*', help='PE files to benchmark on. \
+            Large binaries give the most meaningful numbers.')
+    ent.add_argument('--size', type=int, default=0, \
+            help='also benchmark on a random buffer of this many MB.')
+    ent.add_argument('--repeat', type=int, default=3, \
+            help='best of this many runs is reported.')
+    ent.set_defaults(func=bench_entropy)
+
+    scan = sub.add_parser('scan', help='scanner throughput on synthetic \
+            corpora')
+    scan.add_argument('--corpus', default='synthcorpus', \
+            help='directory to write (and reuse) the corpus in.')
+    scan.add_argument('--sizes', type=int, nargs='+', \
+            default=[1000, 100000, 1000000], \
+            help='corpus sizes to measure, in files.')
+    scan.add_argument('-w', '--workers', type=int, default=1, \
+            help='pescanner worker processes.')
+    scan.add_argument('--fast', action='store_true', \
+            help='use pescanner --fast mode.')
+    scan.add_argument('--imports', action='store_true', \
+            help='also measure imports.py.')
+    synthpe.add_corpus_args(scan)
+    scan.set_defaults(func=bench_scan)
+
+    args = parser.parse_args()
+    args.func(args)
+
+if __name__ == '__main__':
+    main()
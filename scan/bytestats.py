@@ -0,0 +1,179 @@
+""" Vectorized byte statistics (entropy and the like) for the scanners. """
+###############################################################
+# Name:         bytestats
+# Description:  pefile computes entropy with a pure python loop over every
+#               byte, which used to dominate the time pescanner spent on a
+#               file. These functions do the same math with numpy bincount
+#               over a zero-copy view of the bytes instead.
+#
+#               Every function takes anything that exposes the buffer
+#               interface (str, bytearray, mmap, numpy arrays).
+###############################################################
+
+import mmap
+from contextlib import contextmanager
+import numpy as np
+
+###############################################################
+# CONSTANTS ####################
+COUNT_BLOCKSIZE = 1 << 20 # bytes handed to np.bincount at a time
+SAMPLE_BLOCKS = 16         # evenly spaced blocks read by sampled_entropy
+POOL_CHUNKSIZE = 16        # files handed to a worker at a time by the
+                           # feature extractors (pesig, ngrams, pestrings)
+
+###############################################################
+# FUNCTIONS ####################
+
+def map_file(fname):
+    """Returns a read-only memory map of the file fname, to be closed by the
+    caller. Empty files can not be mapped, so they give '' instead, which
+    every function here takes as no bytes."""
+    with open(fname, 'rb') as f:
+        try:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            return ''
+
+@contextmanager
+def mapped_file(fname):
+    """map_file for the length of a with block, closing the map after"""
+    data = map_file(fname)
+    try:
+        yield data
+    finally:
+        if(data):
+            data.close()
+
+def byte_view(data, offset=0, length=None):
+    """Returns a zero-copy uint8 numpy view of data[offset:offset+length].
+    The range is clipped to the buffer, like slicing would be."""
+    size = len(data)
+    if(offset >= size or offset < 0):
+        return np.zeros(0, dtype=np.uint8)
+    if(length is None or offset + length > size):
+        length = size - offset
+    if(length <= 0):
+        return np.zeros(0, dtype=np.uint8)
+    return np.frombuffer(data, dtype=np.uint8, count=length, offset=offset)
+
+def byte_counts(view):
+    """Returns the 256 byte value counts of a uint8 view.
+    bincount casts its input to intp, so it is fed fixed-size blocks to keep
+    that temporary copy small no matter how big the view is."""
+    counts = np.zeros(256, dtype=np.int64)
+    for start in range(0, view.size, COUNT_BLOCKSIZE):
+        counts += np.bincount(view[start:start+COUNT_BLOCKSIZE], minlength=256)
+    return counts
+
+def counts_entropy(counts):
+    """Returns the Shannon entropy in bits per byte of a byte_counts array"""
+    total = counts.sum()
+    if(total == 0):
+        return 0.0
+    probs = counts[counts > 0] / float(total)
+    return 0.0 - float(np.sum(probs * np.log2(probs)))
+
+def entropy(data):
+    """Returns the Shannon entropy of data in bits per byte (0 to 8).
+    Matches pefile's SectionStructure.entropy_H."""
+    view = data
+    if(not isinstance(view, np.ndarray)):
+        view = byte_view(data)
+    return counts_entropy(byte_counts(view))
+
+def sampled_entropy(view, limit):
+    """Estimates the entropy of a uint8 view from at most limit of its bytes,
+    taken as SAMPLE_BLOCKS evenly spaced blocks. Only those blocks are read."""
+    if(view.size <= limit):
+        return entropy(view)
+    blocksize = max(limit // SAMPLE_BLOCKS, 1)
+    step = view.size // SAMPLE_BLOCKS
+    counts = np.zeros(256, dtype=np.int64)
+    for block in range(SAMPLE_BLOCKS):
+        counts += byte_counts(view[block*step:block*step+blocksize])
+    return counts_entropy(counts)
+
+def section_entropy(pe, section, limit=None):
+    """Returns the entropy of a pefile section's raw data without copying it
+    out of the file. Uses the same byte range as section.get_data().
+    If limit is given, sections larger than limit bytes are sampled."""
+    offset = pe.adjust_FileAlignment(section.PointerToRawData, \
+        pe.OPTIONAL_HEADER.FileAlignment)
+    end = min(offset + section.SizeOfRawData, \
+        section.PointerToRawData + section.SizeOfRawData)
+    view = byte_view(pe.__data__, offset, end - offset)
+    if(limit is not None):
+        return sampled_entropy(view, limit)
+    return entropy(view)
+
+###############################################################
+# BYTE HISTOGRAMS ##############
+HIST_WINDOW = 2048 # bytes per window of the byte-entropy histogram
+HIST_STEP = 1024   # bytes between the starts of consecutive windows
+HIST_BINS = 16     # entropy bins x high-nibble bins
+HIST_BLOCKS = 1024 # steps counted at a time, to bound temporary memory
+
+def byte_histogram(view):
+    """Returns the 256-bin byte histogram of a uint8 view (integer counts)"""
+    return byte_counts(view)
+
+def step_nibble_counts(view):
+    """Returns a (steps, HIST_BINS) array counting the high nibbles (byte >> 4)
+    in every HIST_STEP bytes of view. Trailing bytes that do not fill a step
+    are left out."""
+    nsteps = view.size // HIST_STEP
+    counts = np.zeros((nsteps, HIST_BINS), dtype=np.int64)
+    for start in range(0, nsteps, HIST_BLOCKS):
+        stop = min(start + HIST_BLOCKS, nsteps)
+        # A zero-copy (steps, HIST_STEP) window onto the bytes
+        steps = view[start*HIST_STEP:stop*HIST_STEP].reshape(-1, HIST_STEP)
+        # Offset each step's nibbles into its own range and count them all
+        # with one bincount
+        rows = np.arange(stop - start, dtype=np.intp)[:, np.newaxis]
+        flat = (rows * HIST_BINS + (steps >> 4)).ravel()
+        counts[start:stop] = np.bincount(flat, \
+            minlength=(stop - start) * HIST_BINS).reshape(-1, HIST_BINS)
+    return counts
+
+def byte_entropy_histogram(view):
+    """
+    Returns the HIST_BINS x HIST_BINS byte-entropy histogram of a uint8 view,
+    flattened to HIST_BINS**2 integer counts. Every HIST_WINDOW byte window
+    (starting every HIST_STEP bytes) adds its high-nibble counts to the row of
+    its entropy bin, so the histogram says which byte values occur in how
+    random a context. Views shorter than a window count as one window.
+    """
+    hist = np.zeros((HIST_BINS, HIST_BINS), dtype=np.int64)
+    if(view.size == 0):
+        return hist.ravel()
+    if(view.size < HIST_WINDOW):
+        windows = np.bincount(view >> 4, minlength=HIST_BINS)[np.newaxis, :]
+    else:
+        # Each window is two consecutive steps
+        steps = step_nibble_counts(view)
+        windows = steps[:-1] + steps[1:]
+
+    # Entropy of each window's nibbles, 0 to 4 bits, into HIST_BINS bins
+    probs = windows / windows.sum(axis=1, dtype=np.float64)[:, np.newaxis]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        logs = np.where(probs > 0, np.log2(probs), 0.0)
+    entropies = -np.sum(probs * logs, axis=1)
+    ebins = np.minimum((entropies * HIST_BINS / 4.0).astype(np.intp), \
+        HIST_BINS - 1)
+
+    for ebin in np.unique(ebins):
+        hist[ebin] += windows[ebins == ebin].sum(axis=0)
+    return hist.ravel()
+
+def histogram_names():
+    """The column names of byte_histogram and byte_entropy_histogram"""
+    return ['ByteHist%d' % (i) for i in range(256)] + \
+        ['ByteEntropyHist%d' % (i) for i in range(HIST_BINS * HIST_BINS)]
+
+def histogram_features(data):
+    """Returns the byte histogram followed by the byte-entropy histogram of
+    data (anything with the buffer interface, e.g. an mmap of the file), as
+    one list of ints in the order of histogram_names"""
+    view = byte_view(data)
+    return byte_histogram(view).tolist() + \
+        byte_entropy_histogram(view).tolist()
@@ -15,6 +15,8 @@ files. '''
 import pefile
 import argparse
 import sys
+import zlib
+import sparsefmt
 
 def getImps(f):
     ''' Return the set of imports in the given file. '''
@@ -25,16 +27,82 @@ def getImps(f):
     # Get the set of imported symbols
     try:
         pe.parse_data_directories()
-        
-        # getattr prevents a crash when a pe doesn't have any imports.
-        for entry in getattr(pe, 'DIRECTORY_ENTRY_IMPORT', []):
-            for imp in entry.imports:
-                myimps.add(imp.name)
+        myimps = pe_imports(pe)
     except AttributeError:
         print('[-] {}: AttributeError'.format(f), file=sys.stderr)
     
     return myimps
 
+def pe_imports(pe):
+    ''' Return the set of imports in an already parsed pefile.PE. '''
+    myimps = set()
+
+    # getattr prevents a crash when a pe doesn't have any imports.
+    for entry in getattr(pe, 'DIRECTORY_ENTRY_IMPORT', []):
+        for imp in entry.imports:
+            myimps.add(imp.name)
+
+    return myimps
+
+def pe_import_pairs(pe):
+    ''' Return the set of 'DLL!symbol' pairs imported by an already parsed
+    pefile.PE. DLL names are lowercased, since Windows ignores their case, and
+    ordinal-only imports become 'DLL!ord<N>'. '''
+    pairs = set()
+    for entry in getattr(pe, 'DIRECTORY_ENTRY_IMPORT', []):
+        dll = (entry.dll or '').lower()
+        for imp in entry.imports:
+            if imp.name is not None:
+                pairs.add('{}!{}'.format(dll, imp.name))
+            else:
+                pairs.add('{}!ord{}'.format(dll, imp.ordinal))
+    return pairs
+
+def getPairs(f):
+    ''' Return the set of 'DLL!symbol' pairs imported by the given file,
+    parsing only its import directory. '''
+    pe = pefile.PE(f, fast_load=True)
+
+    pairs = set()
+    try:
+        pe.parse_data_directories(directories=[ \
+            pefile.DIRECTORY_ENTRY['IMAGE_DIRECTORY_ENTRY_IMPORT']])
+        pairs = pe_import_pairs(pe)
+    except AttributeError:
+        print('[-] {}: AttributeError'.format(f), file=sys.stderr)
+
+    return pairs
+
+def hash_index(pair, dim):
+    ''' The column of an import pair in a hashed feature space of dim
+    columns. '''
+    return (zlib.crc32(pair) & 0xffffffff) % dim
+
+def hashed_features(pairs, dim):
+    ''' Returns the sorted, distinct hashed columns of the import pairs.
+    Pairs that collide share a column, which stays a 0/1 feature. '''
+    return sorted(set(hash_index(pair, dim) for pair in pairs))
+
+def hashed_names(dim):
+    ''' Feature names for the columns of a hashed feature space. '''
+    return ['impHash{}'.format(i) for i in range(dim)]
+
+def import_features(rawimps, imps):
+    ''' Returns a '1' or '0' for each feature in imps, depending on whether it
+    is in the set of imported symbols rawimps. '''
+    feats = []
+    for imp in imps:
+        if imp in rawimps:
+            feats.append('1')
+        else:
+            feats.append('0')
+    return feats
+
+def sparse_features(rawimps, impindex):
+    ''' Returns the sorted feature indices of the imported symbols rawimps,
+    given impindex, a dict from each feature symbol to its index. '''
+    return sorted(impindex[imp] for imp in rawimps if imp in impindex)
+
 def feature_line(label, name, imps):
     ''' Returns a csv line perfectly formatted for isMalware, Name, <imps>'''
     feats = []
@@ -52,17 +120,18 @@ def feature_line(label, name, imps):
     rawimps = getImps(name)
 
     # Add binary feature values for each feature in imps
-    for imp in imps:
-        if imp in rawimps:
-            feats.append('1')
-        else:
-            feats.append('0')
+    feats.extend(import_features(rawimps, imps))
 
     return ', '.join(feats)
 
-def header_line(imps):
+def read_imports(impsFile):
+    ''' Reads the list of import symbols to use as features from an open
+    file with one symbol per line. '''
+    return [imp.strip() for imp in impsFile.readlines()]
+
+def header_line(imps, out=sys.stdout):
     ''' The header line, which is printed unless --append is chosen. '''
-    print('isMalware, Name, {}'.format(', '.join(imps)))
+    print('isMalware, Name, {}'.format(', '.join(imps)), file=out)
 
 def main():
     ''' The main function.'''
@@ -72,23 +141,52 @@ def main():
             symbols from the files in a list of PE\'s.')
     parser.add_argument('fileList', type=argparse.FileType('r'), \
             default=sys.stdin, help='file containing list of PE files.')
-    parser.add_argument('imports', type=argparse.FileType('r'), \
-            help='file containing list of import symbols to use as features.')
+    parser.add_argument('imports', type=argparse.FileType('r'), nargs='?', \
+            help='file containing list of import symbols to use as features. \
+            Not used with --hash-dim.')
     parser.add_argument('label', choices=['malicious', 'benign'], \
             help='whether the given files are benign or malicious.')
     parser.add_argument('--noheader', action='store_true', default=False, \
             help='Do not write a header line.')
+    parser.add_argument('--format', choices=['csv', 'svmlight', 'npz'], \
+            default='csv', help='csv writes a dense 0/1 column per symbol. \
+            svmlight and npz only store the symbols each file imports; \
+            mldata.load_sparse reads them.')
+    parser.add_argument('--hash-dim', type=int, metavar='N', \
+            help='instead of a symbol list, hash every DLL!symbol pair \
+            (ordinal-only imports as DLL!ord<N>) into N columns.')
+    parser.add_argument('-o', '--out', help='file to write to instead of \
+            stdout. Required for npz.')
     args = parser.parse_args()
 
+    if (args.imports is None) == (args.hash_dim is None):
+        parser.error('give either an imports file or --hash-dim')
+    if args.hash_dim is not None and args.hash_dim < 1:
+        parser.error('--hash-dim must be positive')
+    if args.format == 'npz' and args.out is None:
+        parser.error('--format npz needs --out')
+    out = sys.stdout
+    if args.out is not None and args.format != 'npz':
+        out = open(args.out, 'w')
+
     # Get the list of features
     imps = []
-    with args.imports as impsFile:
-        imps = impsFile.readlines()
-        imps = [imp.strip() for imp in imps]
+    if args.hash_dim is not None:
+        imps = hashed_names(args.hash_dim)
+    else:
+        with args.imports as impsFile:
+            imps = read_imports(impsFile)
+
+    impindex = dict((imp, i) for i, imp in enumerate(imps))
+    label = int('malicious' == args.label)
+    rows = sparsefmt.SparseRows()
 
     # Write a header line, if necessary
     if(not args.noheader):
-        header_line(imps)
+        if args.format == 'csv':
+            header_line(imps, out)
+        elif args.format == 'svmlight':
+            print(sparsefmt.svmlight_header(imps), file=out)
    
     # Open up the list of files
     with args.fileList as files:
@@ -100,9 +198,25 @@ def main():
         for line in files.readlines():
             f = line.strip()
 
-            # Generate and print the csv line
-            line = feature_line(args.label, f, imps)
-            print(line)
+            # Find the feature columns set for this file
+            if args.hash_dim is not None:
+                indices = hashed_features(getPairs(f), args.hash_dim)
+            elif args.format != 'csv':
+                indices = sparse_features(getImps(f), impindex)
+
+            # Generate and print the csv line (or the sparse record)
+            if args.format == 'csv' and args.hash_dim is None:
+                print(feature_line(args.label, f, imps), file=out)
+            elif args.format == 'csv':
+                feats = ['0'] * args.hash_dim
+                for i in indices:
+                    feats[i] = '1'
+                print('{}, {}, {}'.format(label, f, ', '.join(feats)), \
+                        file=out)
+            elif args.format == 'svmlight':
+                print(sparsefmt.svmlight_line(label, f, indices), file=out)
+            else:
+                rows.add(label, f, indices)
 
             # For verbosity purposes
             finished += 1
@@ -110,5 +224,10 @@ def main():
                 print("Finished {} {}".format(finished, args.label), \
                         file=sys.stderr)
 
+    if args.format == 'npz':
+        rows.save_npz(args.out, imps)
+    elif out is not sys.stdout:
+        out.close()
+
 if __name__ == '__main__':
     main()
@@ -0,0 +1,169 @@
+from __future__ import print_function
+
+''' Build the list of import symbols that imports.py uses as features. '''
+
+###############################################################
+# Name:         impvocab
+# Description:  Walks lists of malicious and benign PE files once, counting
+#               how many files of each class import each symbol (document
+#               frequency). The counts live in count-min sketches and only the
+#               heaviest symbols are tracked by name, so memory stays bounded
+#               no matter how many distinct symbols the files import.
+#
+#               Writes the top-k symbols, one per line, which is exactly what
+#               imports.py takes as its imports argument, and optionally a csv
+#               of their estimated document frequencies.
+#
+###############################################################
+
+import pefile
+import argparse
+import hashlib
+import random
+import sys
+import numpy as np
+import imports
+
+CLASSES = ['malicious', 'benign']
+HASH_PRIME = (1 << 89) - 1 # a Mersenne prime larger than any 64-bit hash
+HASH_SEED = 0x5eed # the row hashes are the same in every run
+
+class CountMinSketch(object):
+    ''' Approximate counts in a fixed depth x width table of counters.
+    Estimates never undercount, and overcount by at most about
+    e/width * (total count) with probability 1 - exp(-depth). '''
+
+    def __init__(self, width, depth):
+        self.width = width
+        self.table = np.zeros((depth, width), dtype=np.int64)
+        self.rows = np.arange(depth)
+        # Each row hashes with its own (a*h + b) mod HASH_PRIME, so that keys
+        # colliding in one row are unlikely to collide in the others
+        rng = random.Random(HASH_SEED)
+        self.coefs = [(rng.randrange(1, HASH_PRIME), \
+            rng.randrange(HASH_PRIME)) for _ in range(depth)]
+
+    def columns(self, key):
+        ''' The counter of key in every row: a universal hash per row of the
+        64-bit hash of key (the start of its sha1). '''
+        h = int(hashlib.sha1(key).hexdigest()[:16], 16)
+        return [(a*h + b) % HASH_PRIME % self.width for a, b in self.coefs]
+
+    def add(self, key, count=1):
+        ''' Adds count to key, and returns its new estimate. '''
+        cols = self.columns(key)
+        self.table[self.rows, cols] += count
+        return int(self.table[self.rows, cols].min())
+
+    def estimate(self, key):
+        return int(self.table[self.rows, self.columns(key)].min())
+
+class VocabCounter(object):
+    ''' Per-class document frequencies of import symbols, with the heaviest
+    capacity symbols (over all classes) tracked by name. '''
+
+    def __init__(self, capacity, width, depth):
+        self.capacity = capacity
+        self.total = CountMinSketch(width, depth)
+        self.byclass = dict((c, CountMinSketch(width, depth)) for c in CLASSES)
+        self.files = dict((c, 0) for c in CLASSES)
+        self.candidates = {} # symbol -> estimated document frequency
+
+    def add_file(self, label, symbols):
+        ''' Counts one file of class label importing the set symbols. '''
+        self.files[label] += 1
+        for symbol in symbols:
+            self.byclass[label].add(symbol)
+            self.candidates[symbol] = self.total.add(symbol)
+        if len(self.candidates) > 2 * self.capacity:
+            self.prune()
+
+    def prune(self):
+        ''' Forgets all but the capacity heaviest candidates. Symbols that
+        come back later pick up their sketched count again. '''
+        keep = sorted(self.candidates, key=self.candidates.get, \
+            reverse=True)[:self.capacity]
+        self.candidates = dict((s, self.candidates[s]) for s in keep)
+
+    def top(self, k):
+        ''' Returns the k symbols with the highest document frequency. '''
+        return sorted(self.candidates, key=lambda s: (-self.candidates[s], s))[:k]
+
+def file_imports(f):
+    ''' Return the set of named imports in the given file, parsing only its
+    import directory. Ordinal-only imports have no name and are skipped. '''
+    pe = pefile.PE(f, fast_load=True)
+    pe.parse_data_directories(directories=[ \
+        pefile.DIRECTORY_ENTRY['IMAGE_DIRECTORY_ENTRY_IMPORT']])
+    return set(imp for imp in imports.pe_imports(pe) if imp is not None)
+
+def count_list(counter, label, fileList):
+    ''' Counts the imports of every file named in the open file fileList. '''
+    finished = 0
+    for line in fileList:
+        f = line.strip()
+        if not f:
+            continue
+        try:
+            counter.add_file(label, file_imports(f))
+        except (pefile.PEFormatError, AttributeError, IOError) as e:
+            print('[-] {}: {}'.format(f, e), file=sys.stderr)
+
+        # For verbosity purposes
+        finished += 1
+        if (finished % 1000) == 0:
+            print("Finished {} {}".format(finished, label), file=sys.stderr)
+
+def main():
+    ''' The main function.'''
+    parser = argparse.ArgumentParser(description='Build a list of import \
+            symbols for imports.py from lists of malicious and benign PE\'s, \
+            in one pass and bounded memory.')
+    parser.add_argument('outfile', type=argparse.FileType('w'), \
+            help='file to write the top symbols to, one per line.')
+    parser.add_argument('--malicious', type=argparse.FileType('r'), \
+            help='file containing list of malicious PE files.')
+    parser.add_argument('--benign', type=argparse.FileType('r'), \
+            help='file containing list of benign PE files.')
+    parser.add_argument('-k', '--top', type=int, default=1000, \
+            help='number of symbols to keep.')
+    parser.add_argument('--df', type=argparse.FileType('w'), \
+            help='also write the estimated document frequencies of the top \
+            symbols, overall and per class, to this csv.')
+    parser.add_argument('--width', type=int, default=1 << 20, \
+            help='count-min sketch width (counters per row).')
+    parser.add_argument('--depth', type=int, default=4, \
+            help='count-min sketch depth (rows).')
+    args = parser.parse_args()
+
+    if args.malicious is None and args.benign is None:
+        parser.error('give at least one of --malicious and --benign')
+
+    # Track a few times more symbols than will be kept, so that the top k
+    # are still among the candidates after pruning
+    counter = VocabCounter(4 * args.top, args.width, args.depth)
+    for label in CLASSES:
+        fileList = getattr(args, label)
+        if fileList is not None:
+            with fileList:
+                count_list(counter, label, fileList)
+
+    top = counter.top(args.top)
+    with args.outfile as outfile:
+        for symbol in top:
+            outfile.write('{}\n'.format(symbol))
+
+    if args.df is not None:
+        with args.df as dfFile:
+            dfFile.write('Symbol, df, {}\n'.format(', '.join(CLASSES)))
+            for symbol in top:
+                dfFile.write('{}, {}, {}\n'.format(symbol, \
+                    counter.total.estimate(symbol), ', '.join( \
+                    str(counter.byclass[c].estimate(symbol)) \
+                    for c in CLASSES)))
+
+    print('Counted {}'.format(', '.join('{} {} files'.format( \
+        counter.files[c], c) for c in CLASSES)), file=sys.stderr)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,134 @@
+from __future__ import print_function
+
+''' Hashed byte n-gram counts for the files of a pescanner database. '''
+
+###############################################################
+# Name:         ngrams
+# Description:  Counts the byte 2-, 3- and 4-grams of every file named in a
+#               pescanner csv, hashed into a fixed number of columns, and
+#               writes them as a sparse database (see sparsefmt) with one
+#               record per csv row, in the same order and with the same
+#               isMalware and Name, so the two can be used side by side.
+#
+#               Each file is memory-mapped; the n-grams are read as integers
+#               through a strided uint32 view that steps one byte at a time,
+#               and counted with np.bincount, a block at a time, so no python
+#               code runs per byte. --max-bytes caps how much of each file is
+#               read.
+#
+###############################################################
+
+import argparse
+import sys
+from multiprocessing import Pool
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+import bytestats
+import sparsefmt
+
+BLOCKSIZE = 1 << 20 # bytes of n-grams hashed and counted at a time
+HASH_MULTIPLIER = np.uint32(0x9e3779b1) # Fibonacci hashing
+NGRAM_MASKS = {1: 0xff, 2: 0xffff, 3: 0xffffff, 4: 0xffffffff}
+
+def ngram_values(block):
+    ''' Returns, for every byte of a uint8 array, the little-endian uint32
+    of the 4 bytes starting there (zero past the end). They are read through
+    a strided view that steps one byte at a time, then copied out once, since
+    unaligned reads are slow and every n shares them. The n-gram starting at
+    i is the low n bytes of value i, for any n <= 4. '''
+    # (rounded up to whole uint32s, so that it can be viewed as them)
+    padded = np.zeros((block.size + 6) // 4 * 4, dtype=np.uint8)
+    padded[:block.size] = block
+    return np.ascontiguousarray(as_strided(padded.view('<u4'), \
+        shape=(block.size,), strides=(1,)))
+
+def hash_ngrams(values, n, dim):
+    ''' The columns of n-gram values in a hashed space of dim columns.
+    n is mixed in so that, e.g., a 2-gram and a 4-gram of the same value
+    land in different columns. '''
+    hashed = values & np.uint32(NGRAM_MASKS[n])
+    hashed ^= np.uint32(n << 28)
+    hashed *= HASH_MULTIPLIER
+    hashed ^= hashed >> np.uint32(15)
+    if dim & (dim - 1) == 0:
+        hashed &= np.uint32(dim - 1) # a power of two
+    else:
+        hashed %= np.uint32(dim)
+    return hashed
+
+def ngram_counts(view, ns, dim):
+    ''' Returns the dim hashed counts of the n-grams of a uint8 view, for
+    every n in ns. Blocks overlap by 3 bytes, so that every n-gram is
+    counted exactly once. '''
+    counts = np.zeros(dim, dtype=np.int64)
+    for start in range(0, view.size, BLOCKSIZE):
+        values = ngram_values(view[start:start + BLOCKSIZE + 3])
+        for n in ns:
+            # The n-grams that start in this block and end inside the view
+            count = min(BLOCKSIZE, view.size - start - n + 1)
+            if count > 0:
+                counts += np.bincount(hash_ngrams(values[:count], n, dim), \
+                    minlength=dim)
+    return counts
+
+def file_ngrams(args):
+    ''' Returns the sorted columns and counts of the hashed n-grams of a
+    file, for a (filename, ns, dim, maxbytes) tuple. Unreadable files get
+    an empty record, so the output stays aligned with the database. '''
+    fname, ns, dim, maxbytes = args
+    try:
+        with bytestats.mapped_file(fname) as data:
+            counts = ngram_counts(bytestats.byte_view(data, 0, maxbytes), \
+                ns, dim)
+    except (IOError, OSError) as e:
+        print('[-] {}: {}'.format(fname, e), file=sys.stderr)
+        return ([], [])
+    cols = np.flatnonzero(counts)
+    return (cols.tolist(), counts[cols].tolist())
+
+def ngram_names(dim):
+    ''' Feature names for the columns of the hashed n-gram space. '''
+    return ['NGram{}'.format(i) for i in range(dim)]
+
+def main():
+    ''' The main function.'''
+    parser = argparse.ArgumentParser(description='Write hashed byte n-gram \
+            counts for the files in a pescanner database, as a sparse \
+            database aligned with it.')
+    parser.add_argument('db', type=argparse.FileType('r'), \
+            help='pescanner csv database')
+    parser.add_argument('out', help='file to write to')
+    parser.add_argument('--format', choices=['svmlight', 'npz'], \
+            default='npz', help='output format; mldata.load_sparse reads \
+            either.')
+    parser.add_argument('-n', type=int, nargs='+', default=[2, 3, 4], \
+            choices=[1, 2, 3, 4], help='n-gram lengths to count.')
+    parser.add_argument('--dim', type=int, default=1 << 16, \
+            help='number of hashed columns.')
+    parser.add_argument('--max-bytes', type=int, \
+            help='only read this many bytes of each file.')
+    parser.add_argument('-w', '--workers', type=int, default=1, \
+            help='number of worker processes.')
+    args = parser.parse_args()
+
+    with args.db as db:
+        records = list(sparsefmt.db_records(db))
+    tasks = ((name, args.n, args.dim, args.max_bytes) for _, name in records)
+    if args.workers > 1:
+        pool = Pool(args.workers)
+        results = pool.imap(file_ngrams, tasks, \
+            bytestats.POOL_CHUNKSIZE)
+    else:
+        pool = None
+        results = (file_ngrams(task) for task in tasks)
+
+    # imap keeps the database order
+    sparsefmt.write_aligned(args.out, args.format, ngram_names(args.dim), \
+        records, results)
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+if __name__ == '__main__':
+    main()
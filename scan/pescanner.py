@@ -28,15 +28,53 @@
 
 import pefile # the bulk of the work will be done with this
 from os import walk # used to grab the directory contents
+from os import stat # the file identity kept by the scan cache
 from os.path import join, exists, getsize
+try:
+    from os import scandir # python 3.5+
+except ImportError:
+    try:
+        from scandir import scandir # the backport, if it is installed
+    except ImportError:
+        scandir = None # iter_files falls back to os.walk
+import threading
+import struct
+from collections import namedtuple
+from contextlib import contextmanager
+import signal # for the --timeout watchdog
+import resource # for the --max-memory watchdog
+from scanstats import StageClock, ScanStats # for --profile
 import optparse # for parsing command line options
 import sys
 import datetime
+import hashlib
+from multiprocessing import Pool, Manager # for the --workers mode
+from scancache import ScanCache, hash_data # for --cache and --dedup
+import imports # import symbol features, from the same parse
+import archives # for --archives
+from bytestats import section_entropy # vectorized section entropy
+import bytestats # for --bytehist
 
 ###############################################################
 # CONSTANTS ####################
 LOW_ENTROPY = 1
 HIGH_ENTROPY = 7
+POOL_CHUNKSIZE = 16 # files handed to a worker at a time in --workers mode
+FAST_ENTROPY_BYTES = 1 << 20 # most section bytes read for entropy in --fast
+PREFILTER_BYTES = 1024 # bytes read by the prefilter; covers almost any e_lfanew
+MAX_TASKS_PER_WORKER = 1000 # workers are replaced after this many chunks
+TIMEOUT_REPEAT = 0.5 # seconds between ScanTimeouts once a scan is over time
+PAGE_SIZE = resource.getpagesize() # prefault touches one byte in each
+
+
+###############################################################
+# EXCEPTIONS ###################
+
+class ScanTimeout(BaseException):
+    """Raised inside a scan that ran past its --timeout. It is not an
+    Exception, so that pefile's own except: clauses are less likely to eat
+    it; if one does, it is raised again every TIMEOUT_REPEAT seconds."""
+    pass
 
 
 ###############################################################
@@ -44,11 +82,97 @@ HIGH_ENTROPY = 7
 
 def get_all_files(root):
     """This function will go through the subdirectories recursively"""
-    filelist = []
-    for root, sub, files in walk(root):
-        for filename in files:
-            filelist.append( join(root, filename) )
-    return filelist
+    return list(iter_files(root))
+
+def wanted_file(filename, exts=None, minsize=None, maxsize=None, size=None):
+    """
+    Checks a file name against the optional filters of iter_files.
+    size is only looked up (with getsize) if a size filter needs it.
+    """
+    if(exts is not None and not filename.lower().endswith(tuple(exts))):
+        return False
+    if(minsize is not None or maxsize is not None):
+        if(size is None):
+            try:
+                size = getsize(filename)
+            except OSError:
+                return True # let the scan report the problem
+        if(minsize is not None and size < minsize):
+            return False
+        if(maxsize is not None and size > maxsize):
+            return False
+    return True
+
+def iter_files(root, exts=None, minsize=None, maxsize=None):
+    """
+    Generates the files under root recursively, in the same order as
+    os.walk, without ever holding the whole tree in memory.
+    exts: only yield file names ending in one of these (lowercase) extensions
+    minsize, maxsize: only yield files with sizes in this range (bytes)
+    """
+    if(scandir is None):
+        for dirname, sub, files in walk(root):
+            for filename in files:
+                filename = join(dirname, filename)
+                if(wanted_file(filename, exts, minsize, maxsize)):
+                    yield filename
+        return
+
+    dirs = [root]
+    while(dirs):
+        try:
+            entries = scandir(dirs.pop())
+        except OSError:
+            continue # os.walk skips unreadable directories too
+        subdirs = []
+        for entry in entries:
+            if(entry.is_dir(follow_symlinks=False)):
+                subdirs.append(entry.path)
+            elif(entry.is_file()):
+                size = None
+                if(minsize is not None or maxsize is not None):
+                    size = entry.stat().st_size
+                if(wanted_file(entry.path, exts, minsize, maxsize, size)):
+                    yield entry.path
+        subdirs.reverse() # so they are popped in listing order
+        dirs.extend(subdirs)
+
+def iter_file_list(listfile, exts=None, minsize=None, maxsize=None):
+    """Generates the file names in an open file with one name per line,
+    with the same optional filters as iter_files."""
+    for line in listfile:
+        filename = line.strip()
+        if(filename and wanted_file(filename, exts, minsize, maxsize)):
+            yield filename
+
+def pe_prefilter(head, size):
+    """
+    Cheaply checks whether a file could be a PE file, given its first bytes
+    (head) and its size, without constructing a pefile object.
+    Returns None if it could be, otherwise the reason it cannot be.
+    Only files that pefile would also refuse are rejected.
+    """
+    if(size < 64 or len(head) < 64):
+        return 'too small for a DOS header'
+    if(head[:2] != 'MZ'):
+        return 'no MZ signature'
+    e_lfanew = struct.unpack_from('<I', head, 0x3c)[0]
+    if(e_lfanew + 4 > size):
+        return 'e_lfanew out of bounds'
+    if(e_lfanew + 4 <= len(head) and head[e_lfanew:e_lfanew+4] != 'PE\0\0'):
+        return 'no PE signature'
+    return None
+
+def prefilter_file(pathname):
+    """Runs pe_prefilter on the first PREFILTER_BYTES of a file"""
+    try:
+        with open(pathname, 'rb') as f:
+            head = f.read(PREFILTER_BYTES)
+            f.seek(0, 2) # to the end, for the size
+            size = f.tell()
+    except IOError:
+        return 'unreadable'
+    return pe_prefilter(head, size)
 
 def lang_bools(pe):
     """Scours the resource directory of a PE32 file for language information.
@@ -91,11 +215,20 @@ def lang_bools(pe):
     return ret                            
 
 
-def header_line():
+def header_line(imps=None, bytehist=False):
     """
     Returns a CSV column header line
     Update this whenever you add attributes to be measured
+    If bytehist, the byte histogram columns are added
+    If imps (a list of import symbols) is given, they are added as columns
     """
+    if(imps is not None or bytehist):
+        extra = []
+        if(bytehist):
+            extra.extend(bytestats.histogram_names())
+        if(imps is not None):
+            extra.extend(imps)
+        return '%s, %s\n' % (header_line().rstrip('\n'), ', '.join(extra))
     return 'isMalware, Name, NumberOfSections, Year, \
     PointerToSymbolTable, NumberOfSymbols, BYTES_REVERSED_LO, \
     BYTES_REVERSED_HI, RELOCS_STRIPPED, LOCAL_SYMS_STRIPPED, \
@@ -112,14 +245,53 @@ def header_line():
     Language>127, SubLang=0, SubLang=2, .rsrc size, sample size, \
     RaisedException\n'
 
-def pe_analysis(pathname, ftype):
+def fast_pe(pathname, with_imports=False, data=None):
+    """
+    Parses only the headers, the section table and the resource directory of
+    a PE file (plus the import directory if with_imports). pefile memory-maps
+    the file, so the rest of it is never read in.
+    If data is given, it is parsed instead of the file pathname.
+    """
+    if(data is not None):
+        pe = pefile.PE(data=data, fast_load=True)
+    else:
+        pe = pefile.PE(pathname, fast_load=True)
+    directories = [pefile.DIRECTORY_ENTRY['IMAGE_DIRECTORY_ENTRY_RESOURCE']]
+    if(with_imports):
+        directories.append( \
+            pefile.DIRECTORY_ENTRY['IMAGE_DIRECTORY_ENTRY_IMPORT'])
+    pe.parse_data_directories(directories=directories)
+    return pe
+
+def pe_analysis(pathname, ftype, imps=None, fast=False, clock=None, \
+    data=None, bytehist=False):
     """
     Returns a string with attribute data for the paricular pe file
     Should be tried and caught
-    Return format should follow that of header_line()
+    Return format should follow that of header_line(imps, bytehist)
+    If imps (a list of import symbols) is given, the binary import features
+    from imports.py are appended, using the same parse of the file
+    If fast, only the parts of the file the features need are parsed (see
+    fast_pe), and the entropy of large sections is estimated from a sample
+    clock (a scanstats.StageClock) is lapped at the end of every stage
+    If data (the file's content) is given, it is scanned instead of reading
+    pathname, which is then only the name to report
+    If bytehist, the byte and byte-entropy histograms of the whole file are
+    appended (see bytestats.histogram_features)
     """
+    if(clock is None):
+        clock = StageClock()
+
     # Grab the PE data
-    pe = pefile.PE(pathname)
+    entropy_limit = None
+    if(fast):
+        pe = fast_pe(pathname, imps is not None, data)
+        entropy_limit = FAST_ENTROPY_BYTES
+    elif(data is not None):
+        pe = pefile.PE(data=data)
+    else:
+        pe = pefile.PE(pathname)
+    clock.lap('parse')
 
     # Organize the data into a list
     pe_list = []
@@ -187,6 +359,8 @@ def pe_analysis(pathname, ftype):
     pe_list.append( pe.OPTIONAL_HEADER.LoaderFlags )
     pe_list.append( pe.OPTIONAL_HEADER.NumberOfRvaAndSizes )
     
+    clock.lap('headers')
+
     # Section information
     raw_size_bool = 0           # RawSize == 0
     virtual_lt_raw_bool = 0     # VirtualSize > RawSize
@@ -217,7 +391,10 @@ def pe_analysis(pathname, ftype):
             ptr_reloc_bool = 1
         if(section.PointerToLinenumbers != 0):
             ptr_line_nums_bool = 1
-        entropy = section.get_entropy() # This one really slows down the program
+        # numpy; section.get_entropy() really slows down the program
+        clock.lap('sections')
+        entropy = section_entropy(pe, section, entropy_limit)
+        clock.lap('entropy')
         if(entropy < LOW_ENTROPY):
             sml_entropy_bool = 1
         if(entropy > HIGH_ENTROPY):
@@ -234,6 +411,7 @@ def pe_analysis(pathname, ftype):
     pe_list.append(ptr_line_nums_bool)
     pe_list.append(sml_entropy_bool)
     pe_list.append(large_entropy_bool)
+    clock.lap('sections')
 
     # PE resource Indicators
     # This checks the resource file languages for anything abnormal
@@ -242,39 +420,461 @@ def pe_analysis(pathname, ftype):
         if(this_bool is -1):
             raised_exception = 1
         pe_list.append(this_bool)
+    clock.lap('langs')
     
     # Resource size and the actual sample size (for comparison)
     pe_list.append(rsrc_size)
-    pe_list.append(getsize(pathname))
+    if(data is not None):
+        pe_list.append(len(data))
+    else:
+        pe_list.append(getsize(pathname))
 
     # RaisedException indicates if anything in the scan caused an exception to be raised
     pe_list.append(raised_exception)
 
+    # Byte histograms, if they were asked for (pe.__data__ is the mmap)
+    if(bytehist):
+        pe_list.extend(bytestats.histogram_features(pe.__data__))
+        clock.lap('bytehist')
+
+    # Import symbols, if they were asked for
+    if(imps is not None):
+        pe_list.extend(imports.import_features(imports.pe_imports(pe), imps))
+        clock.lap('imports')
+
     # Create a line of CSV from the data
     pe_list.reverse() # To pop from the other side
     csv_str = ('{}'.format(pe_list.pop()) )
     while(pe_list):
         csv_str += (', {}'.format(pe_list.pop()) )
+    clock.lap('format')
 
     return csv_str
     
 
+# Settings for scan_file that are the same for every file in a run.
+# They are set with init_scan, which also initializes the worker processes.
+scan_settings = {'imports': None, 'fast': False, 'timeout': None, \
+    'memory': None, 'profile': False, 'archives': False, 'maxsize': None, \
+    'bytehist': False, 'digest': False, 'dedup': False, 'claims': None}
+
+def init_scan(settings):
+    """Updates scan_settings. Used as the worker pool initializer."""
+    scan_settings.update(settings)
+
+def scan_jobs(filelist, ftype, cache=None):
+    """
+    Generates the (filename, ftype, passthrough) jobs for scan_file.
+    passthrough is None when the file needs to be scanned. Otherwise it is
+    the (csv line, message, digest) to report without scanning, which happens
+    when the file is unchanged since it was stored in cache (a
+    scancache.ScanCache).
+    """
+    for filename in filelist:
+        passthrough = None
+        if(cache is not None):
+            cached = cache.lookup(filename, ftype)
+            if(cached is not None):
+                passthrough = (cached[0], '%s (cached)' % (cached[1]), \
+                    cached[2])
+        yield (filename, ftype, passthrough)
+
+def claim_digest(name, digest):
+    """
+    With the dedup setting, claims the content with digest (raw sha256) for
+    name in the claims setting, which maps digests to canonical names and is
+    shared by every process that scans. Returns the canonical name if another
+    name claimed the content first, so the file is a duplicate, else None.
+    """
+    claims = scan_settings['claims']
+    if(claims is None or digest is None):
+        return None
+    canonical = claims.setdefault(digest, name)
+    if(canonical == name):
+        return None
+    return canonical
+
+def duplicate_result(name, canonical, fresh, digest, filestat, timings=None, \
+        nbytes=0):
+    """The ScanResult of a file whose content canonical already claimed"""
+    return ScanResult(name, None, '%s is a duplicate of %s' % (name, \
+        canonical), fresh, None, None, timings, nbytes, digest, filestat, \
+        canonical)
+
+def prefault(data):
+    """Touches every page of data (e.g. a memory map of the file), so that
+    --profile times reading the file from disk on its own, rather than in
+    whichever stage happens to look at each page first"""
+    bytestats.byte_view(data)[::PAGE_SIZE].sum()
+
+def vm_size():
+    """Returns this process's address space size in bytes, or None if it
+    cannot be found (it is read from /proc)"""
+    try:
+        with open('/proc/self/statm') as statm:
+            pages = int(statm.read().split()[0])
+    except (IOError, ValueError, IndexError):
+        return None
+    return pages * resource.getpagesize()
+
+def on_scan_timeout(signum, frame):
+    raise ScanTimeout()
+
+@contextmanager
+def scan_budget(pathname, timeout=None, memory=None, size=None):
+    """
+    Runs the body under a wall clock budget of timeout seconds, after which
+    ScanTimeout is raised inside it, and an address space budget of memory
+    bytes on top of what the process and the file's mapping already take,
+    past which allocations raise MemoryError. None means no budget.
+    size is the size of the file, if it is already known.
+    The timer keeps firing until the body ends, and the address space limit
+    is put back even if it fires on the way out.
+    """
+    oldlimit = None
+    if(memory is not None):
+        current = vm_size()
+        if(current is not None):
+            if(size is None):
+                try:
+                    size = getsize(pathname) # pefile maps the whole file
+                except OSError:
+                    size = 0
+            oldlimit = resource.getrlimit(resource.RLIMIT_AS)
+            newlimit = current + size + memory
+            if(oldlimit[1] != resource.RLIM_INFINITY):
+                newlimit = min(newlimit, oldlimit[1])
+            resource.setrlimit(resource.RLIMIT_AS, (newlimit, oldlimit[1]))
+    if(timeout is not None):
+        signal.signal(signal.SIGALRM, on_scan_timeout)
+        signal.setitimer(signal.ITIMER_REAL, timeout, TIMEOUT_REPEAT)
+    try:
+        yield
+    finally:
+        try:
+            if(timeout is not None):
+                signal.setitimer(signal.ITIMER_REAL, 0)
+        finally:
+            if(oldlimit is not None):
+                resource.setrlimit(resource.RLIMIT_AS, oldlimit)
+
+# What scan_file reports about one file:
+# name: the file name
+# row: the csv line, or None if the file did not produce one
+# message: what to print about the file
+# fresh: whether the file was actually scanned (not a passthrough job)
+# rejected: the pe_prefilter reason, if the prefilter rejected the file
+# quarantined: the reason, if the scan ran over its time or memory budget
+# timings: with the profile setting, the StageClock times of a fresh scan
+# nbytes: with the profile setting, the bytes read (the prefilter's read if
+#   the file was rejected, else the whole file)
+# digest: with the digest setting, the raw sha256 digest of the content
+# filestat: the (size, mtime) of the file from before it was read for digest
+# canonical: with the dedup setting, the name of the file this one is a
+#   duplicate of (it is then neither parsed nor prefilter rejected)
+ScanResult = namedtuple('ScanResult', 'name row message fresh rejected \
+    quarantined timings nbytes digest filestat canonical')
+
+def scan_file(job, data=None):
+    """
+    Runs pe_analysis on a single (filename, ftype, passthrough) job.
+    See scan_jobs for passthrough.
+    If data is given, it is scanned as the content of filename (which is
+    then only a name, e.g. of an archive member).
+    Files that fail the prefilter are not handed to pefile at all.
+    Files that exceed the time or memory budget in scan_settings are
+    abandoned and reported as quarantined.
+    With the digest setting (for --cache and --dedup), the file is mapped
+    and hashed here, in the worker, and the same bytes are scanned, so it is
+    only read once and the digest always matches the row. With the dedup
+    setting, the digest is then claimed (see claim_digest), and a duplicate
+    is reported as such without being parsed. With the profile
+    setting, it is mapped here too, and read in full before the scan.
+    The per-file errors are caught here so that one bad file never kills the
+    run, whether it is scanned in this process or in a worker process.
+    Returns a ScanResult
+    """
+    filename, ftype, passthrough = job
+    if(passthrough is not None):
+        canonical = claim_digest(filename, passthrough[2])
+        if(canonical is not None):
+            return duplicate_result(filename, canonical, False, \
+                passthrough[2], None)
+        return ScanResult(filename, passthrough[0], passthrough[1], False, \
+            None, None, None, 0, passthrough[2], None, None)
+
+    mapped = None
+    filestat = None
+    if(data is None and \
+            (scan_settings['digest'] or scan_settings['profile'])):
+        try:
+            st = stat(filename) # before reading, so later changes show
+            mapped = bytestats.map_file(filename)
+        except (IOError, OSError):
+            pass # the prefilter reports the file as unreadable
+        else:
+            data = mapped
+            filestat = (st.st_size, st.st_mtime)
+    try:
+        return scan_contents(filename, ftype, data, filestat)
+    finally:
+        if(mapped):
+            mapped.close()
+
+def scan_contents(filename, ftype, data=None, filestat=None):
+    """The scan of scan_file, of data if it is given, else of filename"""
+    clock = StageClock()
+    row = None
+    quarantined = None
+    digest = None
+    nbytes = 0
+    if(data is not None):
+        rejected = pe_prefilter(data[:PREFILTER_BYTES], len(data))
+        nbytes = min(len(data), PREFILTER_BYTES)
+    else:
+        rejected = prefilter_file(filename)
+    clock.lap('prefilter')
+    if(data is not None):
+        # (rejected files are only read in full if they are to be hashed)
+        if(scan_settings['profile'] and \
+                (rejected is None or scan_settings['digest'])):
+            prefault(data)
+            nbytes = len(data)
+            clock.lap('read')
+        if(scan_settings['digest']):
+            digest = hash_data(data)
+            clock.lap('hash')
+    canonical = claim_digest(filename, digest)
+    if(canonical is not None):
+        timings = None
+        if(scan_settings['profile']):
+            timings = clock.times
+        return duplicate_result(filename, canonical, True, digest, filestat, \
+            timings, nbytes)
+    if(rejected is not None):
+        message = '%s is not a pefile: %s' % (filename, rejected)
+    else:
+        try:
+            size = None
+            if(data is not None):
+                size = len(data)
+            with scan_budget(filename, scan_settings['timeout'], \
+                    scan_settings['memory'], size):
+                row = pe_analysis(filename, ftype, scan_settings['imports'], \
+                    scan_settings['fast'], clock, data, \
+                    scan_settings['bytehist'])
+            message = 'Examined %s' % (filename)
+        except pefile.PEFormatError as pfe:
+            message = '%s is not a pefile: %s' % (filename, str(pfe))
+        except UnboundLocalError as ule:
+            message = 'Problems with %s: %s' % (filename, str(ule))
+        except AttributeError as ae:
+            message = 'Problems with %s: %s' % (filename, str(ae))
+        except ScanTimeout:
+            quarantined = 'over %g seconds' % (scan_settings['timeout'])
+        except MemoryError:
+            quarantined = 'out of memory'
+        if(quarantined is not None):
+            message = 'Quarantined %s: %s' % (filename, quarantined)
+            clock.lap('parse') # the stage that was running is unknown
+
+    timings = None
+    if(scan_settings['profile']):
+        timings = clock.times
+    return ScanResult(filename, row, message, True, rejected, quarantined, \
+        timings, nbytes, digest, filestat, None)
+
+def scan_archive(job, kind):
+    """
+    Runs scan_file on every member of the archive in a (filename, ftype,
+    passthrough) job, with kind from archives.archive_type.
+    Returns the list of ScanResults, named archive!member.
+    Every member is read (decompressed) under the same budget as its scan,
+    and a member that runs over it is quarantined.
+    """
+    filename, ftype, passthrough = job
+    results = []
+    try:
+        for member, read, error in archives.iter_members(filename, kind, \
+                scan_settings['maxsize']):
+            name = archives.member_name(filename, member)
+            data = None
+            quarantined = None
+            if(read is not None):
+                try:
+                    with scan_budget(name, scan_settings['timeout'], \
+                            scan_settings['memory'], 0):
+                        data = read()
+                    if(data is None):
+                        error = 'larger than %d bytes' % \
+                            (scan_settings['maxsize'])
+                except archives.READ_ERRORS as e:
+                    error = str(e)
+                except ScanTimeout:
+                    quarantined = 'over %g seconds reading it' % \
+                        (scan_settings['timeout'])
+                except MemoryError:
+                    quarantined = 'out of memory reading it'
+            if(quarantined is not None):
+                results.append(ScanResult(name, None, 'Quarantined %s: %s' \
+                    % (name, quarantined), True, None, quarantined, None, 0, \
+                    None, None, None))
+            elif(data is None):
+                results.append(ScanResult(name, None, 'Problems with %s: %s' \
+                    % (name, error), True, None, None, None, 0, None, None, \
+                    None))
+            else:
+                results.append(scan_file((name, ftype, None), data))
+    except Exception as e:
+        # A corrupt archive; the members read so far are still reported
+        results.append(ScanResult(filename, None, 'Problems with %s: %s' % \
+            (filename, str(e)), True, None, None, None, 0, None, None, None))
+    return results
+
+def scan_path(job):
+    """
+    Returns the list of ScanResults of a scan_jobs job: one for a file, or
+    one for every member if it is an archive and the archives setting is on.
+    This is what the worker pool runs, so a whole archive is one task.
+    """
+    filename, ftype, passthrough = job
+    if(passthrough is None and scan_settings['archives']):
+        kind = archives.archive_type(filename)
+        if(kind is not None):
+            return scan_archive(job, kind)
+    return [scan_file(job)]
+
+def scan_files(jobs, workers=1, ordered=True, settings={}):
+    """
+    Generates the scan_file results for every job from scan_jobs, and for
+    every archive member with the archives setting.
+    With more than one worker, the files are fanned out over a process pool
+    and the results come back either in input order (ordered) or in the order
+    the workers finish them.
+    settings are applied to scan_settings in every process that scans.
+    With the dedup setting, the digests are claimed in a dict of this run,
+    which a Manager process shares with the workers.
+    """
+    manager = None
+    if(settings.get('dedup')):
+        if(workers <= 1):
+            claims = {}
+        else:
+            manager = Manager()
+            claims = manager.dict()
+        settings = dict(settings, claims=claims)
+    init_scan(settings)
+    if(workers <= 1):
+        for job in jobs:
+            for result in scan_path(job):
+                yield result
+        return
+
+    # The pool reads jobs as fast as it can, so only let a bounded number of
+    # them be in flight. Otherwise the whole walk ends up in its task queue.
+    # The pool's task thread waits on the window, so if the results stop
+    # being read (an error, Ctrl-C, or the generator being closed), it is
+    # told to stop and let through once, or terminate() would wait on it
+    # forever.
+    window = threading.Semaphore(workers * POOL_CHUNKSIZE * 4)
+    stop = threading.Event()
+    def throttled(jobs):
+        for job in jobs:
+            window.acquire()
+            if(stop.is_set()):
+                return
+            yield job
+
+    pool = Pool(workers, init_scan, (settings,), MAX_TASKS_PER_WORKER)
+    try:
+        if(ordered):
+            results = pool.imap(scan_path, throttled(jobs), POOL_CHUNKSIZE)
+        else:
+            results = pool.imap_unordered(scan_path, throttled(jobs), \
+                POOL_CHUNKSIZE)
+        for pathresults in results:
+            window.release()
+            for result in pathresults:
+                yield result
+        pool.close()
+    except:
+        stop.set()
+        window.release()
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+        if(manager is not None):
+            manager.shutdown()
+
+
 ###############################################################
 # MAIN #########################
 
 def main():
     # Handle options
-    parser = optparse.OptionParser("usage: %prog -d <directory>")
+    parser = optparse.OptionParser("usage: %prog -d <directory> | \
+-l <file list>")
     parser.add_option('-d', dest='directory', type='string', \
             help='the directory you want to scan')
+    parser.add_option('-l', '--file-list', dest='filelist', type='string', \
+            help='scan the files named in this file (one per line) instead \
+            of a directory; - reads the names from stdin')
+    parser.add_option('--ext', dest='exts', type='string', \
+            help='only scan files with these comma-separated extensions, \
+            e.g. .exe,.dll')
+    parser.add_option('--min-size', dest='minsize', type='int', \
+            help='only scan files of at least this many bytes')
+    parser.add_option('--max-size', dest='maxsize', type='int', \
+            help='only scan files of at most this many bytes')
     parser.add_option('-o', dest='output', type='string', \
             help='the name of the output file')
     parser.add_option('-t', dest='ftype', type='string', \
             help='the type of file: either malware or clean')
     parser.add_option('-a', action='store_true', dest='append', default=False, \
             help='append to an existing file rather than overwrite it')
+    parser.add_option('-w', '--workers', dest='workers', type='int', \
+            default=1, help='number of worker processes to scan with')
+    parser.add_option('--unordered', action='store_true', dest='unordered', \
+            default=False, help='with --workers, write results in the order \
+            they finish rather than in directory order')
+    parser.add_option('-c', '--cache', dest='cache', type='string', \
+            help='scan cache file; unchanged files are not parsed again')
+    parser.add_option('--dedup', dest='aliases', type='string', \
+            help='leave out the rows of files whose content was already \
+            scanned, and write the duplicate names and their canonical names \
+            to this file')
+    parser.add_option('-i', '--imports', dest='imports', type='string', \
+            help='file with a list of import symbols (as used by \
+            imports.py) to add as columns from the same parse')
+    parser.add_option('--archives', action='store_true', dest='archives', \
+            default=False, help='scan the members of zip (password \
+            infected) and tar archives in memory, as archive!member; \
+            --max-size applies to the members too')
+    parser.add_option('--bytehist', action='store_true', dest='bytehist', \
+            default=False, help='add the 256-bin byte histogram and the \
+            16x16 byte-entropy histogram of the whole file as columns')
+    parser.add_option('--fast', action='store_true', dest='fast', \
+            default=False, help='memory-map each file and only parse the \
+            headers, section table and resources; the entropy of sections \
+            over 1 MB is estimated from a 1 MB sample')
+    parser.add_option('--timeout', dest='timeout', type='float', \
+            help='give up on a file after this many seconds')
+    parser.add_option('--max-memory', dest='memory', type='int', \
+            help='give up on a file that needs more than this many MB \
+            beyond the size of the file itself')
+    parser.add_option('-q', '--quarantine', dest='quarantine', \
+            type='string', help='write the files given up on by --timeout \
+            or --max-memory, and why, to this file')
+    parser.add_option('--profile', action='store_true', dest='profile', \
+            default=False, help='time every stage of every scan and print \
+            a throughput report at the end; every file that passes the \
+            prefilter is read in full first, to time the I/O apart')
+    parser.add_option('--timings', dest='timings', type='string', \
+            help='with --profile, also write the raw per-file timings to \
+            this file')
     (options, args) = parser.parse_args()
-    if(options.directory == None):
+    if(options.directory == None and options.filelist == None):
         options.directory = raw_input("What directory do you want to scan? ")
     if(options.output == None):
         options.output = raw_input("Name of output file? ")
@@ -282,11 +882,17 @@ def main():
         options.ftype = raw_input("Are these files 'malware' or 'clean' ")
 
 
+    # Get the import symbols to add as features, if any
+    imps = None
+    if(options.imports != None):
+        with open(options.imports) as impsFile:
+            imps = imports.read_imports(impsFile)
+
     # Open a file for writing
     if(not options.append):
         outfile = open(options.output, 'w')
         # Write the header data
-        outfile.write(header_line())
+        outfile.write(header_line(imps, options.bytehist))
 
     else: # Simply append to the file
         if(exists(options.output)):
@@ -296,21 +902,109 @@ def main():
             append.' % (options.output)
             sys.exit(1)
 
-    # Get the list of files to scan
-    filelist = get_all_files(options.directory)
+    # Open the scan cache, if there is one
+    cache = None
+    if(options.cache != None):
+        # Rows with import columns are kept apart from rows without them
+        variant = ''
+        if(imps is not None):
+            variant = 'imports:%s' % \
+                (hashlib.sha256('\n'.join(imps)).hexdigest())
+        if(options.fast): # sampled entropy may differ
+            variant += ' fast'
+        if(options.archives): # archives are scanned rather than rejected
+            variant += ' archives'
+        if(options.bytehist):
+            variant += ' bytehist'
+        cache = ScanCache(options.cache, variant)
+
+    # Open the duplicate alias table, if one was requested
+    aliases = None
+    if(options.aliases != None):
+        aliases = open(options.aliases, 'w')
+        aliases.write('Name, CanonicalName\n')
+
+    # Get the files to scan. They are generated as the scan goes.
+    exts = None
+    if(options.exts != None):
+        exts = [ext.strip().lower() for ext in options.exts.split(',')]
+    if(options.filelist == '-'):
+        filelist = iter_file_list(sys.stdin, exts, options.minsize, \
+            options.maxsize)
+    elif(options.filelist != None):
+        filelist = iter_file_list(open(options.filelist), exts, \
+            options.minsize, options.maxsize)
+    else:
+        filelist = iter_files(options.directory, exts, options.minsize, \
+            options.maxsize)
+    jobs = scan_jobs(filelist, options.ftype, cache)
+
+    # Open the quarantine list, if one was requested
+    quarantine = None
+    if(options.quarantine != None):
+        quarantine = open(options.quarantine, 'w')
+        quarantine.write('Name, Reason\n')
+
+    memory = None
+    if(options.memory != None):
+        memory = options.memory << 20
+    # Set up the instrumentation, if it was asked for
+    stats = None
+    timingsfile = None
+    if(options.timings != None):
+        options.profile = True
+        timingsfile = open(options.timings, 'w')
+    if(options.profile):
+        stats = ScanStats(timingsfile)
+
+    settings = {'imports': imps, 'fast': options.fast, \
+        'timeout': options.timeout, 'memory': memory, \
+        'profile': options.profile, 'archives': options.archives, \
+        'maxsize': options.maxsize, 'bytehist': options.bytehist, \
+        'digest': cache is not None or aliases is not None, \
+        'dedup': aliases is not None}
+    rejections = {} # prefilter reason -> number of files
 
     # run the pe_analysis on every file in filelist
-    for filename in filelist:
-        try:
-            result = pe_analysis(filename, options.ftype) 
-            outfile.write('%s\n' % (result))
-            print 'Examined %s' % (filename)
-        except pefile.PEFormatError as pfe:
-            print '%s is not a pefile: %s' % (filename, str(pfe))           
-        except UnboundLocalError as ule:
-            print 'Problems with %s: %s' % (filename, str(ule))
-        except AttributeError as ae:
-            print 'Problems with %s: %s' % (filename, str(ae))
+    # (this process is the single writer, even when there are workers)
+    for result in scan_files(jobs, options.workers, not options.unordered, \
+            settings):
+        if(result.quarantined is not None):
+            if(quarantine is not None):
+                quarantine.write('%s, %s\n' % (result.name, \
+                    result.quarantined))
+        elif(result.fresh and result.canonical is None and \
+                cache is not None):
+            # (quarantined files are left out so a bigger budget retries them,
+            # and duplicates, which have no row of their own to keep)
+            cache.store(result.name, options.ftype, result.row, \
+                result.message, result.digest, result.filestat)
+        if(result.canonical is not None):
+            aliases.write('%s, %s\n' % (result.name, result.canonical))
+        if(result.row is not None):
+            outfile.write('%s\n' % (result.row))
+        if(result.rejected is not None):
+            rejections[result.rejected] = rejections.get(result.rejected, 0) + 1
+        if(stats is not None):
+            stats.add(result.name, result.timings, result.nbytes)
+        print result.message
+
+    for reason in sorted(rejections):
+        print 'Rejected by the prefilter (%s): %d' % (reason, \
+            rejections[reason])
+
+    if(cache is not None):
+        print 'Scan cache: %d unchanged, %d rescanned' % (cache.hits, \
+            cache.misses)
+        cache.close()
+    if(aliases is not None):
+        aliases.close()
+    if(quarantine is not None):
+        quarantine.close()
+    if(stats is not None):
+        print stats.summary()
+    if(timingsfile is not None):
+        timingsfile.close()
 
 
 if __name__ == '__main__':
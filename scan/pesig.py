@@ -0,0 +1,116 @@
+''' Generate the isSigned and totalEntropy features of sigcheck.py without
+running sigcheck.exe. '''
+
+###############################################################
+# Name:         pesig
+# Description:  sigcheck.py runs wine sigcheck.exe once per file, which costs
+#               hundreds of milliseconds each and needs a Windows binary.
+#               This reads the same two features in-process:
+#
+#               isSigned: 1 if the security data directory holds an
+#               Authenticode (PKCS#7 signed data) certificate. The signature
+#               is NOT verified, so this is the presence of a signature, where
+#               sigcheck reports whether it verified.
+#
+#               totalEntropy: the entropy of the whole file in bits per byte,
+#               rounded to an int like sigcheck.get_entropy does. It is
+#               counted with numpy over a memory map of the file.
+#
+#               The output is the same 'Name, isSigned, totalEntropy' csv
+#               that sigcheck.py writes, for add_features.py.
+###############################################################
+
+import pefile
+import argparse
+import struct
+import sys
+from multiprocessing import Pool
+import bytestats
+import get_names
+
+###############################################################
+# CONSTANTS ####################
+WIN_CERT_TYPE_PKCS_SIGNED_DATA = 2
+SECURITY_DIRECTORY = pefile.DIRECTORY_ENTRY['IMAGE_DIRECTORY_ENTRY_SECURITY']
+
+###############################################################
+# FUNCTIONS ####################
+
+def is_signed(pe):
+    ''' Returns 1 if the security directory of a pefile.PE (header parse
+    only is enough) holds an Authenticode certificate, else 0. '''
+    dirs = pe.OPTIONAL_HEADER.DATA_DIRECTORY
+    if len(dirs) <= SECURITY_DIRECTORY:
+        return 0
+    security = dirs[SECURITY_DIRECTORY]
+
+    # Unlike the other directories, this one's address is a file offset
+    offset = security.VirtualAddress
+    data = pe.__data__
+    if security.Size < 8 or offset <= 0 or offset + 8 > len(data):
+        return 0
+
+    # WIN_CERTIFICATE: dwLength, wRevision, wCertificateType
+    length, _, certtype = struct.unpack('<IHH', data[offset:offset+8])
+    if length < 8 or certtype != WIN_CERT_TYPE_PKCS_SIGNED_DATA:
+        return 0
+    return 1
+
+def total_entropy(data):
+    ''' The whole-file entropy, rounded to an int for scikit-learn's sake. '''
+    return int(round(bytestats.entropy(data)))
+
+def signature_features(fname):
+    ''' Returns (isSigned, totalEntropy) for the given file. Files that are
+    not PE files have no signature, but still get an entropy. '''
+    with bytestats.mapped_file(fname) as data:
+        try:
+            signed = is_signed(pefile.PE(data=data, fast_load=True))
+        except pefile.PEFormatError:
+            signed = 0
+        return (signed, total_entropy(data))
+
+def sigline(fname):
+    ''' Returns the csv line for fname, or None if it could not be read. '''
+    try:
+        signed, entropy = signature_features(fname)
+    except (IOError, OSError) as e:
+        sys.stderr.write('[-] {}: {}\n'.format(fname, e))
+        return None
+    return '{}, {}, {}'.format(fname, signed, entropy)
+
+def main():
+    parser = argparse.ArgumentParser(description='Write the isSigned and \
+            totalEntropy features of sigcheck.py, without sigcheck.exe.')
+    parser.add_argument('db', help='csv database')
+    parser.add_argument('outfile', type=argparse.FileType('w'), \
+        help='File to write to')
+    parser.add_argument('--header', action='store_true', \
+        help='Whether or not to output a csv header line')
+    parser.add_argument('-w', '--workers', type=int, default=1, \
+        help='number of worker processes')
+    args = parser.parse_args()
+
+    # If requested by args.header, write a csv header line
+    if args.header:
+        args.outfile.write('Name, isSigned, totalEntropy\n')
+
+    fnames = get_names.names(args.db)
+    if args.workers > 1:
+        pool = Pool(args.workers)
+        lines = pool.imap(sigline, fnames, bytestats.POOL_CHUNKSIZE)
+    else:
+        lines = (sigline(fname) for fname in fnames)
+
+    # Rows come back in database order, as add_features.py expects
+    for line in lines:
+        if line:
+            args.outfile.write('{}\n'.format(line))
+
+    if args.workers > 1:
+        pool.close()
+        pool.join()
+
+
+if __name__ == '__main__':
+    main()
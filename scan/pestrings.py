@@ -0,0 +1,188 @@
+from __future__ import print_function
+
+''' Printable-string features for the files of a pescanner database. '''
+
+###############################################################
+# Name:         pestrings
+# Description:  Finds the printable ASCII and UTF-16LE strings of every file
+#               named in a pescanner csv and writes, for each one, a few
+#               aggregate counts (strings, URLs, registry paths, IP-like
+#               strings, file paths) followed by the counts of the strings
+#               themselves hashed into --dim columns. The output is a sparse
+#               database (see sparsefmt) aligned with the csv rows.
+#
+#               The strings are found with numpy, as runs in a mask of the
+#               printable bytes of a memory map of the file, so the file is
+#               never read into a python string; only the strings are copied
+#               out. (The re module is several times slower at this.)
+#               The aggregate counts come from compiled regexes run over the
+#               strings joined into one.
+#
+###############################################################
+
+import argparse
+import re
+import sys
+import zlib
+from multiprocessing import Pool
+import numpy as np
+import bytestats
+import sparsefmt
+
+MIN_LENGTH = 5 # shortest run of printable characters that is a string
+BLOCKSIZE = 1 << 22 # bytes searched for strings at a time
+BREAK_SEARCH = 1 << 12 # bytes looked at at a time for the end of a block
+
+# The bytes that can not be inside any string: not printable ASCII, and not
+# the zero of a UTF-16LE character
+BREAKS = np.ones(256, dtype=np.bool_)
+BREAKS[0x20:0x7f] = False
+BREAKS[0] = False
+
+# The aggregate counts, in column order, and what they count
+STAT_NAMES = ['StrCount', 'StrUtf16Count', 'StrMeanLength', 'StrUrls', \
+    'StrRegistryPaths', 'StrIPs', 'StrPaths']
+STAT_RES = [
+    re.compile(r'(?:https?|ftp)://', re.IGNORECASE),
+    re.compile(r'\b(?:HKEY_[A-Z_]+|HK(?:LM|CU|CR|U))\\', re.IGNORECASE),
+    re.compile(r'(?<![\d.])(?:\d{1,3}\.){3}\d{1,3}(?![\d.])'),
+    re.compile(r'\b[A-Za-z]:\\|\\\\[\w.$-]+\\'),
+]
+
+def blocks(view):
+    ''' Generates (start, end) blocks of about BLOCKSIZE bytes covering a
+    uint8 view, each ending just before a BREAKS byte, so that no string
+    spans two blocks. '''
+    start = 0
+    while start < view.size:
+        end = start + BLOCKSIZE
+        while end < view.size:
+            hits = np.flatnonzero(BREAKS[view[end:end + BREAK_SEARCH]])
+            if hits.size:
+                end += int(hits[0])
+                break
+            end += BREAK_SEARCH
+        end = min(end, view.size)
+        yield (start, end)
+        start = end
+
+def printable(block):
+    ''' Returns the bool mask of the printable ASCII bytes (0x20 to 0x7e)
+    of a uint8 array. The subtraction wraps, so one compare does it. '''
+    return (block - np.uint8(0x20)) < np.uint8(0x7f - 0x20)
+
+def runs(mask, minlength):
+    ''' Returns the starts and ends of the runs of True in a bool array
+    that are at least minlength long.
+    ANDing minlength shifted copies of the mask first leaves only the
+    starts of long enough runs, which are few, so finding the edges of
+    what is left is cheap even when the mask has many short runs. '''
+    count = mask.size - minlength + 1
+    if count <= 0:
+        return (np.zeros(0, dtype=np.intp), np.zeros(0, dtype=np.intp))
+    long_enough = mask[:count].copy()
+    for k in range(1, minlength):
+        long_enough &= mask[k:k + count]
+    # (np.flatnonzero is much faster on bools than on the int8 diff)
+    edges = np.flatnonzero(np.diff(np.concatenate(([False], long_enough, \
+        [False])).view(np.int8)).astype(np.bool_))
+    return (edges[::2], edges[1::2] + minlength - 1)
+
+def find_strings(view):
+    ''' Returns the ASCII strings and the UTF-16LE strings (as ASCII) of a
+    uint8 view, e.g. of an mmap. Only the strings themselves are copied. '''
+    asciis = []
+    utf16s = []
+    for start, end in blocks(view):
+        block = view[start:end]
+        chars = printable(block)
+
+        starts, ends = runs(chars, MIN_LENGTH)
+        asciis.extend(block[s:e].tostring() for s, e in zip(starts, ends))
+
+        # UTF-16LE characters are a printable byte and a zero, at either
+        # parity
+        pairs = chars[:-1] & (block[1:] == 0)
+        for parity in (0, 1):
+            starts, ends = runs(pairs[parity::2], MIN_LENGTH)
+            utf16s.extend(block[parity + 2*s:parity + 2*e:2].tostring() \
+                for s, e in zip(starts, ends))
+    return (asciis, utf16s)
+
+def string_features(asciis, utf16s, dim):
+    ''' Returns the sorted (indices, values) of the string features: the
+    STAT_NAMES counts, then the strings hashed into dim columns. '''
+    strings = asciis + utf16s
+    stats = [len(strings), len(utf16s), 0]
+    if strings:
+        stats[2] = int(round(sum(len(s) for s in strings) / \
+            float(len(strings))))
+    text = '\n'.join(strings)
+    stats.extend(len(regex.findall(text)) for regex in STAT_RES)
+
+    hashes = np.array([zlib.crc32(s) & 0xffffffff for s in strings], \
+        dtype=np.uint64) % np.uint64(dim)
+    counts = np.bincount(hashes.astype(np.intp), minlength=dim)
+    cols = np.flatnonzero(counts)
+
+    indices = [i for i, v in enumerate(stats) if v]
+    values = [stats[i] for i in indices]
+    indices.extend((cols + len(STAT_NAMES)).tolist())
+    values.extend(counts[cols].tolist())
+    return (indices, values)
+
+def file_strings(args):
+    ''' Returns the string features of a file, for a (filename, dim) tuple.
+    Unreadable files get an empty record, so the output stays aligned with
+    the database. '''
+    fname, dim = args
+    try:
+        with bytestats.mapped_file(fname) as data:
+            asciis, utf16s = find_strings(bytestats.byte_view(data))
+    except (IOError, OSError) as e:
+        print('[-] {}: {}'.format(fname, e), file=sys.stderr)
+        return ([], [])
+    return string_features(asciis, utf16s, dim)
+
+def string_names(dim):
+    ''' Feature names, in column order. '''
+    return STAT_NAMES + ['StrHash{}'.format(i) for i in range(dim)]
+
+def main():
+    ''' The main function.'''
+    parser = argparse.ArgumentParser(description='Write printable-string \
+            features for the files in a pescanner database, as a sparse \
+            database aligned with it.')
+    parser.add_argument('db', type=argparse.FileType('r'), \
+            help='pescanner csv database')
+    parser.add_argument('out', help='file to write to')
+    parser.add_argument('--format', choices=['svmlight', 'npz'], \
+            default='npz', help='output format; mldata.load_sparse reads \
+            either.')
+    parser.add_argument('--dim', type=int, default=1 << 16, \
+            help='number of hashed string columns.')
+    parser.add_argument('-w', '--workers', type=int, default=1, \
+            help='number of worker processes.')
+    args = parser.parse_args()
+
+    with args.db as db:
+        records = list(sparsefmt.db_records(db))
+    tasks = ((name, args.dim) for _, name in records)
+    if args.workers > 1:
+        pool = Pool(args.workers)
+        results = pool.imap(file_strings, tasks, \
+            bytestats.POOL_CHUNKSIZE)
+    else:
+        pool = None
+        results = (file_strings(task) for task in tasks)
+
+    # imap keeps the database order
+    sparsefmt.write_aligned(args.out, args.format, string_names(args.dim), \
+        records, results)
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,140 @@
+""" Persistent cache of pescanner results, so rescans skip unchanged files. """
+###############################################################
+# Name:         scancache
+# Description:  pescanner can be given a cache file (-c). The cache is a small
+#               SQLite database that remembers, for every (path, ftype) it has
+#               scanned, the file's size, mtime and sha256 along with the CSV
+#               row (or the error message) that pe_analysis produced.
+#
+#               On a rescan a file is a cache hit when its size and mtime are
+#               unchanged. When only the mtime changed (e.g. the tree was
+#               copied or touched) the content hash is checked before giving
+#               up, so the file still does not have to be parsed again.
+#
+#               The hash of a new file is computed by pescanner from the same
+#               bytes it scans (see hash_data), and stored with the row, so
+#               the file is not read again to store it.
+#
+#               Rows made with different settings (e.g. with import symbol
+#               columns) are kept apart by the cache's variant string.
+###############################################################
+
+import sqlite3
+import hashlib
+import binascii
+import threading
+from os import stat
+
+###############################################################
+# CONSTANTS ####################
+HASH_BLOCKSIZE = 1 << 20 # bytes read at a time when hashing a file
+COMMIT_EVERY = 1000      # stores between commits
+
+
+###############################################################
+# FUNCTIONS ####################
+
+def hash_file(pathname):
+    """Returns the sha256 hex digest of a file, streamed in one read"""
+    sha = hashlib.sha256()
+    with open(pathname, 'rb') as f:
+        block = f.read(HASH_BLOCKSIZE)
+        while(block):
+            sha.update(block)
+            block = f.read(HASH_BLOCKSIZE)
+    return sha.hexdigest()
+
+def hash_data(data):
+    """Returns the raw sha256 digest of data (a str or an mmap), hashed a
+    block at a time so that an mmap is never copied whole"""
+    sha = hashlib.sha256()
+    for start in range(0, len(data), HASH_BLOCKSIZE):
+        sha.update(data[start:start + HASH_BLOCKSIZE])
+    return sha.digest()
+
+class ScanCache(object):
+    """
+    A persistent map from (path, ftype, variant) to the last scan of a file.
+    Lookups can come from the thread that feeds a worker pool while stores
+    come from the writer, so access to the connection is serialized.
+    """
+
+    def __init__(self, fname, variant=''):
+        self.conn = sqlite3.connect(fname, check_same_thread=False)
+        self.conn.text_factory = str # paths are not necessarily unicode
+        self.conn.execute('CREATE TABLE IF NOT EXISTS scans ( \
+            path TEXT, ftype TEXT, variant TEXT, size INTEGER, mtime REAL, \
+            sha256 TEXT, row TEXT, message TEXT, \
+            PRIMARY KEY (path, ftype, variant))')
+        self.lock = threading.Lock()
+        self.variant = variant
+        self.pending = 0
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, pathname, ftype):
+        """
+        Returns the cached (row, message, digest) for pathname if the file
+        has not changed since it was stored, otherwise None.
+        row is None when the file could not be scanned last time. digest is
+        the raw sha256 digest of the file.
+        """
+        try:
+            st = stat(pathname)
+        except OSError:
+            return None
+
+        with self.lock:
+            entry = self.conn.execute('SELECT size, mtime, sha256, row, \
+                message FROM scans WHERE path=? AND ftype=? AND variant=?', \
+                (pathname, ftype, self.variant)).fetchone()
+        if(entry is None or entry[0] != st.st_size):
+            self.misses += 1
+            return None
+        size, mtime, digest, row, message = entry
+
+        if(mtime != st.st_mtime):
+            # The file was touched; only trust the row if the content matches
+            try:
+                if(hash_file(pathname) != digest):
+                    self.misses += 1
+                    return None
+            except IOError:
+                self.misses += 1
+                return None
+            with self.lock:
+                self.conn.execute('UPDATE scans SET mtime=? WHERE path=? \
+                    AND ftype=? AND variant=?', (st.st_mtime, pathname, \
+                    ftype, self.variant))
+                self._count_store()
+
+        self.hits += 1
+        return (row, message, binascii.unhexlify(digest))
+
+    def store(self, pathname, ftype, row, message, digest, filestat):
+        """
+        Records the result of scanning pathname. digest is the raw sha256
+        digest of the bytes that were scanned and filestat the file's (size,
+        mtime) from before they were read. Without them there is nothing
+        sensible to key the entry on, so it is not stored.
+        """
+        if(digest is None or filestat is None):
+            return
+        with self.lock:
+            self.conn.execute('INSERT OR REPLACE INTO scans VALUES \
+                (?, ?, ?, ?, ?, ?, ?, ?)', (pathname, ftype, self.variant, \
+                filestat[0], filestat[1], binascii.hexlify(digest), row, \
+                message))
+            self._count_store()
+
+    def _count_store(self):
+        """Commits every COMMIT_EVERY changes. Call with the lock held."""
+        self.pending += 1
+        if(self.pending >= COMMIT_EVERY):
+            self.conn.commit()
+            self.pending = 0
+
+    def close(self):
+        with self.lock:
+            self.conn.commit()
+            self.conn.close()
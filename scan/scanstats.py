@@ -0,0 +1,111 @@
+""" Per-stage timing of pescanner scans and a throughput report. """
+###############################################################
+# Name:         scanstats
+# Description:  pe_analysis and scan_file lap a StageClock as they go, so
+#               every bit of a file's scan time is charged to one stage
+#               (prefilter, read, hash, parse, headers, sections, entropy,
+#               langs, bytehist, imports, format). With --profile, pescanner
+#               feeds the laps of every file into a ScanStats, which prints a
+#               summary at the end and can also dump the raw per-file timings
+#               as a CSV. The read stage is pescanner reading the whole file
+#               up front, so that I/O is not charged to the stages after it.
+###############################################################
+
+import time
+import heapq
+from array import array
+
+###############################################################
+# CONSTANTS ####################
+STAGES = ['prefilter', 'read', 'hash', 'parse', 'headers', 'sections', \
+    'entropy', 'langs', 'bytehist', 'imports', 'format']
+SLOWEST = 10 # files listed in the summary
+
+
+###############################################################
+# CLASSES ######################
+
+class StageClock(object):
+    """Charges the time between laps to the named stages"""
+
+    def __init__(self):
+        self.times = {}
+        self.last = time.time()
+
+    def lap(self, stage):
+        """Charges the time since the last lap to stage"""
+        now = time.time()
+        self.times[stage] = self.times.get(stage, 0.0) + (now - self.last)
+        self.last = now
+
+class ScanStats(object):
+    """
+    Collects the per-file timings of a scan and summarizes them.
+    Only the latencies, the stage totals and the slowest files are kept, so
+    memory stays small on large scans. If dumpfile (an open file) is given,
+    the raw timings of every file are written to it as they come in.
+    """
+
+    def __init__(self, dumpfile=None):
+        self.start = time.time()
+        self.files = 0
+        self.nbytes = 0
+        self.latencies = array('d')
+        self.stage_totals = dict((stage, 0.0) for stage in STAGES)
+        self.slowest = [] # heap of (seconds, name)
+        self.dumpfile = dumpfile
+        if(dumpfile is not None):
+            dumpfile.write('Name, bytes, total, %s\n' % (', '.join(STAGES)))
+
+    def add(self, name, timings, nbytes):
+        """Records one file. timings (stage -> seconds) is None for files
+        that were not actually scanned, e.g. cache hits."""
+        self.files += 1
+        if(timings is None):
+            return
+        self.nbytes += nbytes
+        total = sum(timings.values())
+        self.latencies.append(total)
+        for stage, seconds in timings.items():
+            self.stage_totals[stage] = self.stage_totals.get(stage, 0.0) + \
+                seconds
+        if(len(self.slowest) < SLOWEST):
+            heapq.heappush(self.slowest, (total, name))
+        elif(total > self.slowest[0][0]):
+            heapq.heapreplace(self.slowest, (total, name))
+        if(self.dumpfile is not None):
+            self.dumpfile.write('%s, %d, %f, %s\n' % (name, nbytes, total, \
+                ', '.join('%f' % (timings.get(stage, 0.0)) \
+                for stage in STAGES)))
+
+    def percentile(self, sortedlats, pct):
+        """Returns the pct percentile of a sorted list of latencies"""
+        if(not sortedlats):
+            return 0.0
+        idx = int(round(pct / 100.0 * (len(sortedlats) - 1)))
+        return sortedlats[idx]
+
+    def summary(self):
+        """Returns the throughput report as a string"""
+        wall = max(time.time() - self.start, 1e-9)
+        lats = sorted(self.latencies)
+        lines = []
+        lines.append('Files: %d (%d scanned) in %.1f s' % (self.files, \
+            len(lats), wall))
+        lines.append('Throughput: %.1f files/s, %.2f MB/s' % (self.files / \
+            wall, self.nbytes / float(1 << 20) / wall))
+        lines.append('Per-file latency: p50 %.2f ms, p99 %.2f ms' % \
+            (1000 * self.percentile(lats, 50), \
+            1000 * self.percentile(lats, 99)))
+
+        busy = max(sum(self.stage_totals.values()), 1e-9)
+        lines.append('Stage share of scan time:')
+        for stage in sorted(self.stage_totals, \
+                key=lambda s: -self.stage_totals[s]):
+            lines.append('  %-10s %6.1f%%  %.2f s' % (stage, 100 * \
+                self.stage_totals[stage] / busy, self.stage_totals[stage]))
+
+        lines.append('Slowest files:')
+        for seconds, name in sorted(self.slowest, reverse=True):
+            lines.append('  %8.2f ms  %s' % (1000 * seconds, name))
+        return '\n'.join(lines)
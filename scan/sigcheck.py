@@ -3,29 +3,38 @@
 # Created 29 sep 14
 # Bilzor's source: https://github.com/hiddenillusion/AnalyzePE/blob/master/AnalyzePE.py
 
-import subprocess
 import argparse
+import sys
+from itertools import izip
 import get_names
+import toolpool
 
 wine = 'wine' # change if wine is ever not in the path
 # VVV this must be changed for your individual computer VVV
 sigcheck = '/home/markel/sigcheck.exe' 
 
-def sigchecker(fname):
+def sigcheck_args(fname):
+    ''' The argument list that runs sigcheck.exe on fname. '''
+    return [wine, sigcheck, '-q', '-a', fname]
 
-    opts = " -q -a "
-    cmd = wine + ' ' + sigcheck + opts + '"' + fname + '"'
-    p = subprocess.Popen(cmd,stderr=subprocess.PIPE,stdout=subprocess.PIPE,shell=True)
-    (stdout, stderr) = p.communicate()
-    if stdout:
+def sigreport(fname, result):
+    ''' Turns the toolpool.ToolResult of sigcheck on fname into a string for
+    the database, or returns None (after printing why) if it failed. '''
+    if result.timedout:
+        sys.stderr.write('[-] {}: sigcheck timed out\n'.format(fname))
+        return None
+    if result.stdout:
         # Generate a string for the database
-        retstr = '{}, {}, {}'.format(fname,get_isSigned(stdout), \
-            get_entropy(stdout))
+        return '{}, {}, {}'.format(fname, get_isSigned(result.stdout), \
+            get_entropy(result.stdout))
+    sys.stderr.write('[-] {}: {}\n'.format(fname, result.stderr.strip()))
+    return None
+
+def sigchecker(fname, timeout=None):
+    retstr = sigreport(fname, toolpool.run_tool(sigcheck_args(fname), timeout))
+    if retstr:
         print retstr
-        return retstr
-    else: 
-        print stderr
-        return None
+    return retstr
 
 def get_isSigned(stdout):
     ''' Searches through a report from sigcheck.exe and returns whether the
@@ -58,16 +67,25 @@ def main():
         help='File to write to')
     parser.add_argument('--header', action='store_true', \
         help='Whether or not to output a csv header line')
+    parser.add_argument('-j', '--jobs', type=int, default=1, \
+        help='number of sigcheck processes to run at once')
+    parser.add_argument('--timeout', type=float, \
+        help='seconds to give sigcheck on each file before killing it')
     args = parser.parse_args()
 
     # If requested by args.header, write a csv header line
     if args.header:
         args.outfile.write('Name, isSigned, totalEntropy\n')
 
+    # Results come back in database order, so add_features.py can fold them in
     fnames = get_names.names(args.db)
-    for fname in fnames:
-        report = sigchecker(fname)
+    results = toolpool.run_tools((sigcheck_args(fname) for fname in fnames), \
+        args.jobs, args.timeout)
+    # (izip, so that every report is written as soon as its sigcheck ends)
+    for fname, result in izip(fnames, results):
+        report = sigreport(fname, result)
         if report:
+            print report
             args.outfile.write('{}\n'.format(report))
 
 
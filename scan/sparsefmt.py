@@ -0,0 +1,111 @@
+''' Writers for sparse feature databases that mldata.load_sparse can read. '''
+
+###############################################################
+# Name:         sparsefmt
+# Description:  Most of a wide binary feature database (like the import
+#               symbols from imports.py) is zeros, so writing it as a dense
+#               csv wastes space and time. Two sparse formats are written
+#               here instead:
+#
+#               svmlight: one text line per record, "<isMalware> <i>:<v> ...
+#               # <Name>", with zero-based feature indices. The first line is
+#               a comment with the csv style header, "# isMalware, Name, ...",
+#               so that the feature names travel with the data.
+#
+#               npz: a compressed numpy archive holding the CSR arrays (data,
+#               indices, indptr, shape) along with labels, names, featnames.
+#
+###############################################################
+
+from __future__ import print_function
+
+import sys
+import numpy as np
+from array import array
+from itertools import izip
+
+def svmlight_header(featnames):
+    ''' The header comment line of an svmlight database. '''
+    return '# isMalware, Name, {}'.format(', '.join(featnames))
+
+def svmlight_line(label, name, indices, values=None):
+    ''' One svmlight record. indices must be sorted; values defaults to 1
+    for every index. '''
+    if values is None:
+        values = [1] * len(indices)
+    feats = ' '.join('{}:{}'.format(i, v) for i, v in zip(indices, values))
+    if feats:
+        return '{} {} # {}'.format(label, feats, name)
+    return '{} # {}'.format(label, name)
+
+class SparseRows(object):
+    ''' Accumulates sparse records in CSR form, to be saved as an npz. '''
+
+    def __init__(self):
+        self.data = array('l')
+        self.indices = array('l')
+        self.indptr = array('l', [0])
+        self.labels = array('l')
+        self.names = []
+
+    def add(self, label, name, indices, values=None):
+        ''' Adds one record. indices must be sorted; values defaults to 1. '''
+        if values is None:
+            values = [1] * len(indices)
+        self.indices.extend(indices)
+        self.data.extend(values)
+        self.indptr.append(len(self.indices))
+        self.labels.append(label)
+        self.names.append(name)
+
+    def save_npz(self, outfile, featnames):
+        ''' Writes the records to outfile (a file name or an open binary
+        file) as a compressed npz. '''
+        np.savez_compressed(outfile, \
+            data=np.array(self.data, dtype=np.int64), \
+            indices=np.array(self.indices, dtype=np.int32), \
+            indptr=np.array(self.indptr, dtype=np.int64), \
+            shape=np.array([len(self.labels), len(featnames)]), \
+            labels=np.array(self.labels, dtype=np.int64), \
+            names=np.array(self.names, dtype='a255'), \
+            featnames=np.array(featnames))
+
+def db_records(db):
+    ''' Generates the (isMalware, Name) of every record of an open pescanner
+    csv, in order, without loading the rest of it. '''
+    header = db.readline().replace(' ', '').strip().split(',')
+    label = header.index('isMalware')
+    name = header.index('Name')
+    for line in db:
+        fields = line.rstrip('\n').split(', ')
+        if len(fields) > max(label, name):
+            yield (int(fields[label]), fields[name])
+
+def write_aligned(outfile, fmt, featnames, records, results):
+    ''' Writes a sparse database in fmt ('svmlight' or 'npz') to the file
+    name outfile, with one record per (isMalware, Name) in records, whose
+    features are the (indices, values) in results, in the same order.
+    results is consumed as it goes (e.g. a Pool.imap), so each record is
+    written as soon as it is ready. '''
+    rows = SparseRows()
+    out = None
+    if fmt == 'svmlight':
+        out = open(outfile, 'w')
+        print(svmlight_header(featnames), file=out)
+
+    finished = 0
+    for (label, name), (indices, values) in izip(records, results):
+        if out is not None:
+            print(svmlight_line(label, name, indices, values), file=out)
+        else:
+            rows.add(label, name, indices, values)
+
+        # For verbosity purposes
+        finished += 1
+        if (finished % 1000) == 0:
+            print('Finished {}'.format(finished), file=sys.stderr)
+
+    if out is not None:
+        out.close()
+    else:
+        rows.save_npz(outfile, featnames)
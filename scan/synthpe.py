@@ -0,0 +1,307 @@
+from __future__ import print_function
+
+''' Writes synthetic, valid PE32 files for benchmarking the scanners. '''
+
+###############################################################
+# Name:         synthpe
+# Description:  Builds PE32 files from scratch with a controllable size,
+#               section count, section entropy, resource language entries and
+#               import table, so that pescanner.py and imports.py can be
+#               benchmarked without shipping real malware around.
+#
+#               Every file is determined by its seed, so a corpus can be
+#               regenerated exactly anywhere.
+#
+###############################################################
+
+import argparse
+import os
+import random
+import struct
+import numpy as np
+
+###############################################################
+# CONSTANTS ####################
+FILE_ALIGNMENT = 0x200
+SECTION_ALIGNMENT = 0x1000
+IMAGE_BASE = 0x400000
+E_LFANEW = 0x80
+FILES_PER_DIR = 1000 # corpus files are spread over subdirectories
+
+# Entropy profiles, as bits per byte of the section data
+ENTROPY_PROFILES = {'low': 0, 'text': 4, 'code': 6, 'high': 8}
+
+# Some (lang, sublang) pairs to draw resource languages from
+LANGS = [(0x09, 0x01), (0x09, 0x02), (0x07, 0x01), (0x0c, 0x01), \
+    (0x19, 0x01), (0x04, 0x02), (0x00, 0x00), (0x00, 0x01)]
+
+# Some DLLs and symbols to draw import tables from
+DLL_SYMBOLS = {
+    'KERNEL32.dll': ['GetProcAddress', 'LoadLibraryA', 'ExitProcess', \
+        'CreateFileW', 'ReadFile', 'WriteFile', 'CloseHandle', \
+        'VirtualAlloc', 'VirtualProtect', 'GetModuleHandleA', \
+        'CreateProcessW', 'Sleep', 'GetTickCount'],
+    'USER32.dll': ['MessageBoxA', 'GetMessageW', 'DispatchMessageW', \
+        'CreateWindowExW', 'ShowWindow', 'SetWindowsHookExA'],
+    'ADVAPI32.dll': ['RegOpenKeyExA', 'RegSetValueExA', 'RegCloseKey', \
+        'OpenProcessToken', 'CryptAcquireContextA'],
+    'WS2_32.dll': [], # imported by ordinal only
+    'WININET.dll': ['InternetOpenA', 'InternetOpenUrlA', 'InternetReadFile'],
+}
+
+###############################################################
+# FUNCTIONS ####################
+
+def align(value, alignment):
+    ''' Rounds value up to a multiple of alignment. '''
+    return (value + alignment - 1) // alignment * alignment
+
+def section_data(rng, size, bits):
+    ''' Returns size bytes whose entropy is about bits per byte. '''
+    symbols = int(round(2 ** bits))
+    if symbols <= 1:
+        return b'\0' * size
+    nprng = np.random.RandomState(rng.randint(0, 2**31 - 1))
+    return nprng.randint(0, symbols, size=size).astype(np.uint8).tobytes()
+
+def import_section(rva, imports):
+    ''' Builds an import section that will be loaded at rva.
+    imports is a list of (dll name, [symbol names or ordinals]).
+    Returns (section data, import directory size). '''
+    dirsize = 20 * (len(imports) + 1)
+
+    # Lay out the thunk arrays, then the hint/name entries and dll names
+    offset = dirsize
+    thunk_offsets = []
+    for dll, symbols in imports:
+        ilt = offset
+        offset += 4 * (len(symbols) + 1)
+        iat = offset
+        offset += 4 * (len(symbols) + 1)
+        thunk_offsets.append((ilt, iat))
+
+    strings = b''
+    name_offsets = []
+    for dll, symbols in imports:
+        offsets = []
+        for symbol in symbols:
+            if isinstance(symbol, int):
+                offsets.append(None) # ordinal, no hint/name entry
+                continue
+            offsets.append(offset + len(strings))
+            entry = struct.pack('<H', 0) + symbol.encode('ascii') + b'\0'
+            if len(entry) % 2:
+                entry += b'\0'
+            strings += entry
+        dllname = offset + len(strings)
+        strings += dll.encode('ascii') + b'\0'
+        name_offsets.append((offsets, dllname))
+
+    data = b''
+    for (ilt, iat), (offsets, dllname) in zip(thunk_offsets, name_offsets):
+        data += struct.pack('<IIIII', rva + ilt, 0, 0, rva + dllname, \
+            rva + iat)
+    data += b'\0' * 20
+
+    for (dll, symbols), (offsets, _) in zip(imports, name_offsets):
+        thunks = b''
+        for symbol, nameoff in zip(symbols, offsets):
+            if nameoff is None:
+                thunks += struct.pack('<I', 0x80000000 | symbol)
+            else:
+                thunks += struct.pack('<I', rva + nameoff)
+        thunks += struct.pack('<I', 0)
+        data += thunks + thunks # lookup table, then address table
+
+    return data + strings, dirsize
+
+def resource_section(rva, langs, blobsize=64):
+    ''' Builds a resource section that will be loaded at rva, holding one
+    RT_RCDATA resource in each of the (lang, sublang) pairs in langs.
+    Returns (section data, resource directory size). '''
+    def directory(entries):
+        # entries: list of (id, offset, is a subdirectory)
+        data = struct.pack('<IIHHHH', 0, 0, 0, 0, 0, len(entries))
+        for ident, offset, subdir in entries:
+            if subdir:
+                offset |= 0x80000000
+            data += struct.pack('<II', ident, offset)
+        return data
+
+    typedir = 0
+    namedir = typedir + 16 + 8
+    langdir = namedir + 16 + 8
+    dataentries = langdir + 16 + 8 * len(langs)
+    blobs = dataentries + 16 * len(langs)
+
+    data = directory([(10, namedir, True)]) # 10 is RT_RCDATA
+    data += directory([(1, langdir, True)])
+    data += directory([(lang | (sublang << 10), dataentries + 16 * i, False) \
+        for i, (lang, sublang) in enumerate(langs)])
+    for i in range(len(langs)):
+        data += struct.pack('<IIII', rva + blobs + blobsize * i, blobsize, \
+            0, 0)
+    data += b'\x5a' * (blobsize * len(langs))
+    return data, blobs
+
+def build_pe(seed, size=16384, nsections=3, entropy='code', langs=1, \
+        nimports=8, year=2012):
+    ''' Returns the bytes of a valid PE32 file.
+    seed: everything random about the file is drawn from this
+    size: approximate file size in bytes (the data sections are padded to it)
+    nsections: number of data sections (at least 1), besides .idata and .rsrc
+    entropy: an ENTROPY_PROFILES name or bits per byte for the data sections
+    langs: number of resource language entries (0 for no .rsrc section)
+    nimports: number of imported symbols (0 for no .idata section)
+    year: the year of the TimeDateStamp '''
+    rng = random.Random(seed)
+    bits = ENTROPY_PROFILES.get(entropy, entropy)
+
+    # Pick the imports and the resource languages
+    imports = []
+    if nimports > 0:
+        symbols = []
+        for dll in sorted(DLL_SYMBOLS):
+            names = DLL_SYMBOLS[dll] or rng.sample(range(1, 500), 3)
+            symbols += [(dll, name) for name in names]
+        chosen = rng.sample(symbols, min(nimports, len(symbols)))
+        for dll in sorted(set(dll for dll, _ in chosen)):
+            imports.append((dll, [s for d, s in chosen if d == dll]))
+    languages = [rng.choice(LANGS) for _ in range(langs)]
+
+    # Section table: (name, characteristics, data). The data of .idata and
+    # .rsrc depends on where they end up, so it is built during the layout.
+    nheaders = nsections + bool(imports) + bool(languages)
+    headersize = align(E_LFANEW + 4 + 20 + 224 + 40 * nheaders, \
+        FILE_ALIGNMENT)
+    datasize = max(size - headersize, 0) // max(nsections, 1)
+    sections = []
+    for i in range(nsections):
+        name = b'.text' if i == 0 else '.data{}'.format(i).encode('ascii')
+        characteristics = 0x60000020 if i == 0 else 0xC0000040
+        sections.append([name, characteristics, \
+            section_data(rng, align(max(datasize, 1), FILE_ALIGNMENT), bits)])
+    if imports:
+        sections.append([b'.idata', 0xC0000040, None])
+    if languages:
+        sections.append([b'.rsrc', 0x40000040, None])
+
+    # Lay out the sections, building .idata and .rsrc once their rva is known
+    directories = [(0, 0)] * 16
+    rva = SECTION_ALIGNMENT
+    rawptr = headersize
+    layout = []
+    for section in sections:
+        name = section[0]
+        if name == b'.idata':
+            section[2], dirsize = import_section(rva, imports)
+            directories[1] = (rva, dirsize)
+        elif name == b'.rsrc':
+            section[2], dirsize = resource_section(rva, languages)
+            directories[2] = (rva, dirsize)
+        rawsize = align(len(section[2]), FILE_ALIGNMENT)
+        layout.append((name, section[1], section[2], rva, rawptr, rawsize))
+        rva += align(max(len(section[2]), 1), SECTION_ALIGNMENT)
+        rawptr += rawsize
+    imagesize = rva
+
+    codesize = sum(l[5] for l in layout if l[1] & 0x20)
+    initsize = sum(l[5] for l in layout if l[1] & 0x40)
+    basedata = layout[1][3] if len(layout) > 1 else 0
+    timestamp = (year - 1970) * 31556952 + rng.randint(0, 31556952 // 2)
+
+    dos = b'MZ' + b'\0' * 58 + struct.pack('<I', E_LFANEW)
+    dos += b'\0' * (E_LFANEW - len(dos))
+    filehdr = struct.pack('<HHIIIHH', 0x14c, len(layout), timestamp, 0, 0, \
+        224, 0x0102)
+    opthdr = struct.pack('<HBB' + 'I' * 9 + 'H' * 6 + 'I' * 4 + 'HH' + 'I' * 6,
+        0x10b, rng.randint(6, 14), rng.randint(0, 40), codesize, initsize, \
+        0, layout[0][3], layout[0][3], basedata, IMAGE_BASE, \
+        SECTION_ALIGNMENT, FILE_ALIGNMENT, 5, 1, rng.randint(0, 3), 0, 5, 1, \
+        0, imagesize, headersize, 0, 2, 0, 0x100000, 0x1000, 0x100000, \
+        0x1000, 0, 16)
+    for dirva, dirsize in directories:
+        opthdr += struct.pack('<II', dirva, dirsize)
+    sectionhdrs = b''
+    for name, characteristics, data, secrva, secptr, rawsize in layout:
+        sectionhdrs += struct.pack('<8sIIIIIIHHI', name, len(data), secrva, \
+            rawsize, secptr, 0, 0, 0, 0, characteristics)
+
+    headers = dos + b'PE\0\0' + filehdr + opthdr + sectionhdrs
+    parts = [headers + b'\0' * (headersize - len(headers))]
+    for name, characteristics, data, secrva, secptr, rawsize in layout:
+        parts.append(data + b'\0' * (rawsize - len(data)))
+    return b''.join(parts)
+
+def corpus_path(outdir, index):
+    ''' Where file number index of a corpus lives. '''
+    return os.path.join(outdir, '{:04d}'.format(index // FILES_PER_DIR), \
+        'synth{:07d}.exe'.format(index))
+
+def corpus_params(seed, index, args):
+    ''' Draws the build_pe parameters of corpus file number index. '''
+    # (an int seed: a str one goes through hash(), which differs between
+    # builds and under -R)
+    rng = random.Random(seed * 2**32 + index)
+    entropy = args.entropy
+    if entropy == 'mixed':
+        entropy = rng.choice(sorted(ENTROPY_PROFILES))
+    elif entropy not in ENTROPY_PROFILES:
+        entropy = float(entropy)
+    return {'seed': rng.randint(0, 2**31 - 1), \
+            'size': rng.randint(args.min_size, args.max_size), \
+            'nsections': rng.randint(args.min_sections, args.max_sections), \
+            'entropy': entropy, \
+            'langs': rng.randint(0, args.max_langs), \
+            'nimports': rng.randint(0, args.max_imports), \
+            'year': rng.randint(2000, 2014)}
+
+def write_corpus(outdir, count, args, start=0):
+    ''' Writes files start to count-1 of a corpus, skipping existing ones.
+    Returns the number of files written. '''
+    written = 0
+    for index in range(start, count):
+        path = corpus_path(outdir, index)
+        if os.path.exists(path):
+            continue
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as f:
+            f.write(build_pe(**corpus_params(args.seed, index, args)))
+        written += 1
+    return written
+
+def add_corpus_args(parser):
+    ''' The corpus shape arguments, shared with bench.py. '''
+    parser.add_argument('--seed', type=int, default=42, \
+            help='corpus seed. The same seed gives the same files.')
+    parser.add_argument('--min-size', type=int, default=4096, \
+            help='smallest file size in bytes.')
+    parser.add_argument('--max-size', type=int, default=65536, \
+            help='largest file size in bytes.')
+    parser.add_argument('--min-sections', type=int, default=1, \
+            help='fewest data sections.')
+    parser.add_argument('--max-sections', type=int, default=6, \
+            help='most data sections.')
+    parser.add_argument('--entropy', default='mixed', \
+            help='section entropy: low, text, code, high, a number of bits \
+            per byte, or mixed to draw a profile per file.')
+    parser.add_argument('--max-langs', type=int, default=3, \
+            help='most resource language entries.')
+    parser.add_argument('--max-imports', type=int, default=20, \
+            help='most imported symbols.')
+
+def main():
+    ''' The main function.'''
+    parser = argparse.ArgumentParser(description='Write a corpus of \
+            synthetic PE32 files.')
+    parser.add_argument('outdir', help='directory to write the corpus to.')
+    parser.add_argument('count', type=int, help='number of files.')
+    add_corpus_args(parser)
+    args = parser.parse_args()
+
+    written = write_corpus(args.outdir, args.count, args)
+    print('Wrote {} files to {}'.format(written, args.outdir))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+''' Run an external tool over many files, a bounded number at a time. '''
+
+###############################################################
+# Name:         toolpool
+# Description:  Runs external scanners (like sigcheck.exe under wine) with up
+#               to N processes at once. Every invocation is an argument list,
+#               never a shell command line, so file names are passed as they
+#               are, and an invocation that runs longer than its timeout has
+#               its whole process group killed.
+#
+#               Results come back in the order the commands were given, no
+#               matter which one finishes first.
+###############################################################
+
+import os
+import signal
+import subprocess
+import threading
+from collections import namedtuple
+from multiprocessing.pool import ThreadPool
+
+# returncode is None when the tool could not be started at all
+ToolResult = namedtuple('ToolResult', 'args returncode stdout stderr timedout')
+
+def kill_group(p):
+    ''' Kills the process group of p, which run_tool made its leader. '''
+    try:
+        os.killpg(p.pid, signal.SIGKILL)
+    except OSError:
+        pass # it already exited
+
+def run_tool(args, timeout=None):
+    ''' Runs the argument list args and returns a ToolResult.
+    The tool gets its own process group, so that a timeout also kills
+    anything it started (wine starts several processes). '''
+    try:
+        p = subprocess.Popen(args, stdout=subprocess.PIPE, \
+            stderr=subprocess.PIPE, preexec_fn=os.setsid, close_fds=True)
+    except OSError as e:
+        return ToolResult(args, None, '', str(e), False)
+
+    timer = None
+    if timeout is not None:
+        timer = threading.Timer(timeout, kill_group, (p,))
+        timer.start()
+    try:
+        (stdout, stderr) = p.communicate()
+    finally:
+        if timer is not None:
+            timer.cancel()
+
+    # Killed by the timer rather than exiting on its own
+    timedout = timer is not None and p.returncode == -signal.SIGKILL
+    return ToolResult(args, p.returncode, stdout, stderr, timedout)
+
+def run_tools(commands, jobs=1, timeout=None):
+    ''' Runs every argument list in the iterable commands, at most jobs at a
+    time, and yields their ToolResults in the order of commands.
+    Threads are enough here, since they only wait on the processes. '''
+    if jobs <= 1:
+        for args in commands:
+            yield run_tool(args, timeout)
+        return
+
+    pool = ThreadPool(jobs)
+    try:
+        for result in pool.imap(lambda args: run_tool(args, timeout), \
+                commands):
+            yield result
+    finally:
+        pool.terminate()